@@ -2,12 +2,19 @@ from .filters import *
 from .post_processors import *
 from .classifiers import *
 from .classification import ClassifyPipeline
+from .cache import ResultCache
+from .har_utils import DEFAULT_SCAN_WINDOW
+from .loading import load_session, loads_session
+from .batch import FeatureBatch
+from .metrics import PipelineMetrics
 
 # Expose the default pipeline config
-def run(session):
+def default_pipeline(prune_stale_pages=False, cache=None,
+        scan_window=DEFAULT_SCAN_WINDOW, stream_pages=False, time_budget=None,
+        metrics=None):
     filters = [
             RelevanceFilter(),
-            InconclusiveFilter()
+            InconclusiveFilter(scan_window)
             ]
     classifiers = [
             (StatusCodeClassifier(), 1.0),
@@ -17,12 +24,33 @@ def run(session):
             (EmptyPageClassifier(), 1.0),
             (CosineSimilarityClassifier(), 1.0),
             (DifferingDomainClassifier(), 1.0),
-            (BlockpageSignatureClassifier(), 1.0),
+            (BlockpageSignatureClassifier(scan_window=scan_window), 1.0),
             ]
     post_processors = [
             BlockedFinder()
             ]
-    pipeline = ClassifyPipeline(filters, classifiers, post_processors)
+    return ClassifyPipeline(filters, classifiers, post_processors,
+            prune_stale_pages=prune_stale_pages, cache=cache, stream_pages=stream_pages,
+            time_budget=time_budget, metrics=metrics)
+
+def run(session, prune_stale_pages=False, cache=None,
+        scan_window=DEFAULT_SCAN_WINDOW, stream_pages=False, time_budget=None,
+        metrics=None):
+    pipeline = default_pipeline(prune_stale_pages, cache, scan_window, stream_pages,
+            time_budget, metrics)
     classification = pipeline.classify(session)
     return classification
 
+# Updates a previous result with a session holding only new pages. Returns
+# the new classification and the state to pass in next time.
+def run_incremental(previous_state, session, prune_stale_pages=False,
+        scan_window=DEFAULT_SCAN_WINDOW):
+    pipeline = default_pipeline(prune_stale_pages, scan_window=scan_window)
+    classification = pipeline.classify_incremental(previous_state, session)
+    return classification, pipeline.session_state(classification)
+
+# Rescores a stored result, running only the classifiers whose versions have
+# changed since it was made.
+def rerun(stored_result, session, scan_window=DEFAULT_SCAN_WINDOW):
+    pipeline = default_pipeline(scan_window=scan_window)
+    return pipeline.rerun_changed_classifiers(stored_result, session)
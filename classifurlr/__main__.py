@@ -1,4 +1,4 @@
-import argparse, json, logging
+import argparse, json, logging, os, sys
 import classifurlr
 
 def parse_args():
@@ -7,11 +7,59 @@ def parse_args():
             help='file containing JSON detailing HTTP requests + responses')
     parser.add_argument('--debug', action='store_true',
             help='Log debugging info')
-    return parser.parse_args()
+    parser.add_argument('--prune', action='store_true',
+            help='Skip pages too old to affect the verdict. Their IDs are '
+            'listed under "details" in the output')
+    parser.add_argument('--cache', metavar='PATH',
+            help='SQLite file in which to cache results')
+    parser.add_argument('--state', metavar='PATH',
+            help='file holding the state of a previous run. If it exists, '
+            'session_file should only contain new pages. Updated after the run')
+    parser.add_argument('--rerun', metavar='PATH', type=open,
+            help='file holding a previous result for session_file. Only '
+            'classifiers whose versions have changed are run again')
+    parser.add_argument('--scan-window', metavar='KB', type=int, default=0,
+            help='only search this much of each response body for block page '
+            'text, in KB, to bound the time spent on huge pages. 0 (the '
+            'default) searches whole bodies')
+    parser.add_argument('--stream', action='store_true',
+            help='classify one page at a time to keep memory flat on huge sessions')
+    parser.add_argument('--time-budget', metavar='SECONDS', type=float,
+            help='return the best verdict possible in about this long, '
+            'skipping slow classifiers on older pages if need be. Loading and '
+            'filtering aren\'t counted against it. Can\'t be used with --stream')
+    parser.add_argument('--keep-heavy-fields', action='store_true',
+            help='keep screenshots and binary response bodies in memory')
+    parser.add_argument('--compact', action='store_true',
+            help='Output JSON without indentation')
+    args = parser.parse_args()
+    if args.stream and args.time_budget is not None:
+        parser.error('--stream and --time-budget can\'t be used together')
+    return args
 
 if __name__ == '__main__':
     args = parse_args()
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
-    c = classifurlr.run(json.load(args.session_file))
-    print(c.as_json())
+    session = classifurlr.load_session(args.session_file,
+            keep_screenshots=args.keep_heavy_fields,
+            keep_binary_bodies=args.keep_heavy_fields)
+    scan_window = args.scan_window * 1024 or None
+    if args.rerun:
+        c = classifurlr.rerun(json.load(args.rerun), session, scan_window=scan_window)
+    elif args.state:
+        previous = {'result': {}, 'startedDateTimes': {}}
+        if os.path.exists(args.state):
+            with open(args.state) as f:
+                previous = json.load(f)
+        c, state = classifurlr.run_incremental(previous, session,
+                prune_stale_pages=args.prune, scan_window=scan_window)
+        with open(args.state, 'w') as f:
+            json.dump(state, f)
+    else:
+        cache = classifurlr.ResultCache(args.cache) if args.cache else None
+        c = classifurlr.run(session, prune_stale_pages=args.prune, cache=cache,
+                scan_window=scan_window, stream_pages=args.stream,
+                time_budget=args.time_budget)
+    c.dump(sys.stdout, pretty=not args.compact)
+    print()
@@ -0,0 +1,93 @@
+import logging
+
+import numpy as np
+
+from .classification import Classification, Session
+from .features import PageFeatures
+
+# Codes for the directions in FeatureBatch.verdicts
+INCONCLUSIVE, UP, DOWN = -1, 0, 1
+DIRECTIONS = {INCONCLUSIVE: Classification.INCONCLUSIVE, UP: Classification.UP,
+        DOWN: Classification.DOWN}
+
+# Runs the feature classifiers (status code, empty page, page length and
+# throttle) over the pages of many sessions at once. Their logic is a few
+# comparisons per page, so when rescoring an archive it's far faster to stack
+# every session's PageFeatures into one table and compare whole columns than
+# to make a Python call per page per classifier. The stacked table can be
+# saved and loaded, so rescoring with new thresholds doesn't mean parsing
+# the HARs again.
+class FeatureBatch:
+    def __init__(self, features, session_ids, offsets, sessions=None):
+        self.features = features
+        self.session_ids = list(session_ids)
+        # The row each session starts at, plus the total number of rows
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.sessions = sessions
+
+    @classmethod
+    def from_sessions(cls, sessions):
+        sessions = [s if isinstance(s, Session) else Session(s) for s in sessions]
+        tables = [PageFeatures.for_session(session) for session in sessions]
+        offsets = np.cumsum([0] + [len(table) for table in tables])
+        logging.info('Built features for {} pages from {} sessions'.format(
+            offsets[-1], len(sessions)))
+        return cls(PageFeatures.concatenate(tables), [s.url for s in sessions],
+                offsets, sessions)
+
+    def save(self, path):
+        np.savez_compressed(path, columns=np.vstack(self.features.columns()),
+                page_ids=np.array(self.features.page_ids, dtype=str),
+                session_ids=np.array(self.session_ids, dtype=str),
+                offsets=self.offsets)
+
+    # A loaded batch has no sessions, so it can give verdicts but not
+    # Classifications.
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            features = PageFeatures(data['page_ids'].tolist(), data['columns'])
+            return cls(features, data['session_ids'].tolist(), data['offsets'])
+
+    def __len__(self):
+        return len(self.features)
+
+    def session_rows(self, i):
+        return range(self.offsets[i], self.offsets[i + 1])
+
+    # The direction (as a code from DIRECTIONS) and confidence that
+    # classifier.classify_page would give every page in the batch.
+    # Inconclusive pages have a NaN confidence.
+    def verdicts(self, classifier):
+        down_confidences = classifier.down_confidences(self.features)
+        inconclusive = np.isnan(down_confidences)
+        down = down_confidences >= 0.5
+        directions = np.where(inconclusive, INCONCLUSIVE,
+                np.where(down, DOWN, UP)).astype(np.int8)
+        confidences = np.where(down, (down_confidences - 0.5) * 2.0,
+                (0.5 - down_confidences) * 2.0)
+        return directions, confidences
+
+    # The Classification for every page, per session - the same as
+    # classifier.classify_page gives one page at a time.
+    def classify(self, classifier):
+        if self.sessions is None:
+            raise ValueError('Classifying a batch needs the sessions it was built from')
+        directions, confidences = self.verdicts(classifier)
+        results = []
+        for i, session in enumerate(self.sessions):
+            session_results = []
+            for page, row in zip(session.get_pages(), self.session_rows(i)):
+                classification = Classification(page, classifier)
+                if directions[row] == DOWN:
+                    classification.mark_down(float(confidences[row]))
+                elif directions[row] == UP:
+                    classification.mark_up(float(confidences[row]))
+                else:
+                    classification.mark_inconclusive(
+                            classifier.missing_data_error(page, session))
+                if classifier.is_page_blocked(page, session, classification):
+                    classification.mark_blocked()
+                session_results.append(classification)
+            results.append(session_results)
+        return results
@@ -0,0 +1,110 @@
+import json, logging, sqlite3, threading, time, zlib
+
+from . import serialization
+
+# A persistent cache of classification results, stored in a single SQLite
+# file. Results are keyed by the hash of the session's content plus
+# a signature of the pipeline that produced them (every filter and
+# classifier's slug and version, and the classifier weights), so a new
+# classifier version never sees old results.
+# The size of the stored results is kept as a running total rather than summed
+# on every put. Other processes can share the file, so the total is refreshed
+# from the table every RESYNC_EVERY puts.
+RESYNC_EVERY = 1000
+# Eviction goes a little below max_size so it doesn't run on every put.
+EVICT_TO = 0.9
+
+class ResultCache:
+    def __init__(self, path, max_size=512 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size # bytes of stored results
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                    'session_hash TEXT NOT NULL, '
+                    'pipeline_signature TEXT NOT NULL, '
+                    'result BLOB NOT NULL, '
+                    'size INTEGER NOT NULL, '
+                    'last_used REAL NOT NULL, '
+                    'PRIMARY KEY (session_hash, pipeline_signature))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS results_last_used '
+                    'ON results (last_used)')
+        self.total = self.size()
+
+    @staticmethod
+    def pipeline_signature(pipeline):
+        parts = {
+                'pipeline': [pipeline.slug(), pipeline.version],
+                'filters': [[f.slug(), f.version] for f in pipeline.filters],
+                'classifiers': [[c.slug(), c.version, pipeline.weights[c]]
+                    for c in pipeline.classifiers],
+                'post_processors': [pp.name for pp in pipeline.post_processors],
+                'options': [pipeline.look_back_days, pipeline.down_vs_up_weight,
+                    pipeline.prune_stale_pages],
+                }
+        return json.dumps(parts, sort_keys=True)
+
+    def get(self, session_hash, signature):
+        with self.lock:
+            row = self.db.execute('SELECT result FROM results WHERE session_hash = ? '
+                    'AND pipeline_signature = ?', (session_hash, signature)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self.db:
+                self.db.execute('UPDATE results SET last_used = ? WHERE session_hash = ? '
+                        'AND pipeline_signature = ?', (time.time(), session_hash, signature))
+            return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, session_hash, signature, classification):
+        with self.lock:
+            blob = zlib.compress(serialization.dumps(classification).encode('utf-8'))
+            with self.db:
+                # Any result for this session is either replaced or, if it's from
+                # another pipeline version, stale.
+                replaced = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results '
+                        'WHERE session_hash = ?', (session_hash,)).fetchone()[0]
+                self.db.execute('DELETE FROM results WHERE session_hash = ? AND '
+                        'pipeline_signature != ?', (session_hash, signature))
+                self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                        (session_hash, signature, blob, len(blob), time.time()))
+            self.puts += 1
+            if self.puts % RESYNC_EVERY == 0:
+                self.total = self.size()
+            else:
+                self.total += len(blob) - replaced
+            self.evict()
+
+    # Once over max_size, drops least recently used results until we're
+    # EVICT_TO of the way there.
+    def evict(self):
+        with self.lock:
+            if self.total <= self.max_size: return
+            target = self.max_size * EVICT_TO
+            total, doomed = self.total, []
+            for session_hash, signature, size in self.db.execute('SELECT session_hash, '
+                    'pipeline_signature, size FROM results ORDER BY last_used'):
+                if total <= target: break
+                doomed.append((session_hash, signature))
+                total -= size
+            with self.db:
+                self.db.executemany('DELETE FROM results WHERE session_hash = ? AND '
+                        'pipeline_signature = ?', doomed)
+            self.total = total
+            logging.debug('Evicted {} results from cache {}'.format(len(doomed), self.path))
+
+    def size(self):
+        with self.lock:
+            return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def close(self):
+        self.db.close()
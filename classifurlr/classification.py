@@ -1,17 +1,31 @@
-import json, logging, concurrent.futures
+import json, logging, concurrent.futures, hashlib, time
 
-import dateutil.parser
-from haralyzer import HarParser
+import numpy as np
 from .url_utils import extract_domain
+from . import serialization
+from .time_utils import parse_timestamp
+from .har_page import group_entries, iter_pages
 
 class NotEnoughDataError(LookupError):
     pass
 
+class TimeBudgetExceededError(NotEnoughDataError):
+    pass
+
 class Classifier:
     def __init__(self):
         self.name = '__placeholder__'
         self.desc = '__placeholder__'
         self.version = '0.1'
+        # Whether this classifier looks at page timings, which aren't part of
+        # a page's fingerprint - see Session.get_page_fingerprint.
+        self.uses_timings = False
+        # Whether this classifier is slow enough to be worth skipping when
+        # time is short - see ClassifyPipeline.classify_budgeted.
+        self.expensive = False
+        # Whether this classifier's result for a page depends on the session's
+        # other pages - see ClassifyPipeline.classify_incremental.
+        self.looks_across_session = False
 
     def slug(self):
         return self.name.lower().replace(' ', '_')
@@ -51,7 +65,7 @@ class Classification:
     INCONCLUSIVE = 'inconclusive'
 
     def __init__(self, subject, classifier, direction=None, confidence=None,
-            constituents=None, error=None, blocked=None):
+            constituents=None, error=None, blocked=None, details=None):
         self.subject = subject
         self.classifier = classifier
         self.direction = direction
@@ -59,6 +73,9 @@ class Classification:
         self.constituents = constituents
         self.error = error
         self.blocked = blocked
+        # Anything else a classifier wants to report, as a dict. Only
+        # included in the output when set.
+        self.details = details
 
     def subject_id(self):
         if hasattr(self.subject, 'page_id'):
@@ -67,6 +84,25 @@ class Classification:
             return self.subject['url']
         return ''
 
+    # Rebuilds a classification from the output of as_dict. Confidences of
+    # zero come out of as_dict as None, so they're put back.
+    @classmethod
+    def from_dict(cls, d, subject, classifier, constituents=None):
+        confidence = d['confidence']
+        if confidence is None and d['status'] in (cls.UP, cls.DOWN):
+            confidence = 0.0
+        return cls(subject, classifier, d['status'], confidence, constituents,
+                d['error'], d['blocked'], d.get('details'))
+
+    # The same result, but about a different subject. Used to reuse results
+    # for pages that are identical.
+    def for_subject(self, subject):
+        constituents = None
+        if self.constituents is not None:
+            constituents = [c.for_subject(subject) for c in self.constituents]
+        return Classification(subject, self.classifier, self.direction,
+                self.confidence, constituents, self.error, self.blocked, self.details)
+
     def mark_blocked(self):
         self.blocked = True
         self.mark_down(1.0)
@@ -109,27 +145,47 @@ class Classification:
         return next((c for c in self.get_constituents()
             if isinstance(c.classifier, classifier)), None)
 
+    # The scalar fields of the output document, in output order. Shared by
+    # as_dict and the streaming encoder so the schema lives in one place.
+    def as_fields(self):
+        fields = (
+                ('subject', self.subject_id()),
+                ('status', self.direction),
+                ('blocked', self.blocked),
+                ('confidence', round(self.confidence, 6) if self.confidence else None),
+                ('classifier', self.classifier.slug()),
+                ('error', str(self.error) if self.error else None),
+                ('version', self.classifier.version),
+                )
+        if self.details is not None:
+            fields += (('details', self.details),)
+        return fields
+
     def as_dict(self):
-        d = {
-                'subject': self.subject_id(),
-                'status': self.direction,
-                'blocked': self.blocked,
-                'confidence': round(self.confidence, 6) if self.confidence else None,
-                'classifier': self.classifier.slug(),
-                'error': str(self.error) if self.error else None,
-                'version': self.classifier.version
-                }
+        d = dict(self.as_fields())
         if self.constituents is not None:
-            d['constituents'] = []
-            for constituent in self.constituents:
-                d['constituents'].append(constituent.as_dict())
+            d['constituents'] = [c.as_dict() for c in self.constituents]
         return d
 
-    def as_json(self):
-        return json.dumps(self.as_dict(), indent=2)
+    def as_json(self, pretty=True):
+        return serialization.dumps(self, pretty)
+
+    def dump(self, fp, pretty=False, encoding=None):
+        serialization.dump(self, fp, pretty, encoding)
+
+# Whether a result can be reused for an identical page. Error messages often
+# name the page they're about, so results with errors are worked out afresh.
+def reusable(classification):
+    return classification.error is None
+
+def looks_blocked(page_classification):
+    return page_classification.is_blocked() or any(c.is_blocked()
+            for c in page_classification.constituents or [])
 
 class ClassifyPipeline(Classifier):
-    def __init__(self, filters, classifiers, post_processors):
+    def __init__(self, filters, classifiers, post_processors,
+            prune_stale_pages=False, dedupe_pages=True, cache=None, stream_pages=False,
+            time_budget=None, metrics=None):
         Classifier.__init__(self)
         self.name = 'Classification Pipeline'
         self.desc = 'Classifies by passing data through multiple classifiers and weighing their results'
@@ -138,6 +194,18 @@ class ClassifyPipeline(Classifier):
         self.filters = filters
         self.filtered_out = []
         self.post_processors = post_processors
+        self.down_vs_up_weight = 1.5
+        self.look_back_days = 60
+        self.prune_stale_pages = prune_stale_pages
+        self.pruned = []
+        self.dedupe_pages = dedupe_pages
+        self.cache = cache
+        self.stream_pages = stream_pages
+        self.time_budget = time_budget # seconds
+        if stream_pages and time_budget is not None:
+            raise ValueError('stream_pages and time_budget can\'t be used together')
+        self.skipped = []
+        self.metrics = metrics # a metrics.PipelineMetrics, if we're keeping count
 
     # A session is made of multiple pages, a page is made of multiple entries.
     # 1. Each page will first be run through filters that might eliminate it from
@@ -151,19 +219,173 @@ class ClassifyPipeline(Classifier):
     # 5. The pages will be considered together to give a final
     #    up/down/blocked/inconclusive verdict for the session.
     def classify(self, session):
+        started = time.perf_counter()
         session = Session(session)
+        if self.cache is not None:
+            classification = self.classify_cached(session)
+        else:
+            classification = self.classify_uncached(session)
+        if self.metrics is not None:
+            self.metrics.observe_session(classification, time.perf_counter() - started)
+        return classification
+
+    def classify_uncached(self, session):
+        if self.time_budget is not None:
+            return self.classify_budgeted(session)
+        if self.stream_pages:
+            return self.classify_stream(session)
+        return self.classify_session(session)
+
+    def classify_cached(self, session):
+        session_hash = session.get_content_hash()
+        signature = self.cache.pipeline_signature(self)
+        stored = self.cache.get(session_hash, signature)
+        if stored is not None:
+            logging.debug('Cache hit for session {}'.format(session.url))
+            return self.restore_session_classification(stored, session)
+        classification = self.classify_uncached(session)
+        # Don't keep a result that ran out of time in place of a full one.
+        if len(self.skipped) == 0:
+            self.cache.put(session_hash, signature, classification)
+        return classification
+
+    def classify_session(self, session):
         pages = self.filtered_pages(session)
         page_classifications = []
-        if len(pages) == 0:
+        for page in pages:
+            page_classifications.append(self.classify_page(page, session))
+        return self.finish_session(session, page_classifications)
+
+    # Classifies a session a page at a time. Each page is pulled through the
+    # filters and classifiers, then only a compact copy of its result is kept
+    # and its decoded bodies are dropped, so memory stays flat no matter how
+    # many pages there are. Gives the same result as classify_session.
+    def classify_stream(self, session):
+        # har_utils and entry_index import this module
+        from .har_utils import release_entry_content
+        from .entry_index import EntryIndex
+        baseline = session.get_baseline()
+        page_classifications = []
+        for page in self.stream_filtered_pages(session):
+            classification = self.classify_page(page, session)
+            page_classifications.append(classification.for_subject(
+                StoredPage(page.page_id, page.startedDateTime)))
+            if page is not baseline:
+                release_entry_content(page.entries)
+                EntryIndex.for_session(session).release(page.entries)
+        # Pruning works through pages newest first.
+        order = {page_id: i for i, page_id in enumerate(session.get_page_timestamps())}
+        page_classifications.sort(key=lambda c: order[c.subject.page_id])
+        return self.finish_session(session, page_classifications)
+
+    # Classifies within time_budget seconds, for callers that would rather
+    # have a quick answer than a complete one. Cheap classifiers run on every
+    # page first. Then expensive ones run on the newest pages first, since
+    # those count most in rollup_session, until time's up. An expensive
+    # classifier that didn't get to run on a page is inconclusive with
+    # a TimeBudgetExceededError, and is listed in self.skipped. The deadline
+    # is only checked between classifier runs, so a slow classifier can take
+    # it over. The clock starts once the pages are filtered, and the cheap
+    # classifiers always run in full.
+    def classify_budgeted(self, session):
+        pages = self.filtered_pages(session)
+        deadline = time.monotonic() + self.time_budget
+        constituents = {page.page_id: [None] * len(self.classifiers) for page in pages}
+        for page in pages:
+            for i, classifier in enumerate(self.classifiers):
+                if not classifier.expensive:
+                    constituents[page.page_id][i] = self.classify_page_with(
+                            classifier, page, session)
+        self.skipped = []
+        for page in sorted(pages, key=session.get_page_timestamp, reverse=True):
+            for i, classifier in enumerate(self.classifiers):
+                if not classifier.expensive: continue
+                if time.monotonic() < deadline:
+                    c = self.classify_page_with(classifier, page, session)
+                else:
+                    c = Classification(page, classifier)
+                    c.mark_inconclusive(TimeBudgetExceededError('Skipped: time '
+                        'budget of {}s used up'.format(self.time_budget)))
+                    self.skipped.append((page.page_id, classifier.slug()))
+                constituents[page.page_id][i] = c
+        if len(self.skipped) > 0:
+            logging.info('Ran out of time for {} of {} page classifications '
+                    'of session {}'.format(len(self.skipped),
+                        len(pages) * len(self.classifiers), session.url))
+        page_classifications = [self.rollup_single_page(page, constituents[page.page_id])
+                for page in pages]
+        return self.finish_session(session, page_classifications)
+
+    # One classifier's result for a page. Pages in a session often get
+    # byte-identical responses (the same block page over and over), so the
+    # result for the first page with the same fingerprint is reused. Only
+    # classifiers that look at timings are rerun.
+    def classify_page_with(self, classifier, page, session):
+        if not self.dedupe_pages or classifier.uses_timings:
+            return self.run_classifier(classifier, page, session)
+        results = session.page_results.setdefault(session.get_page_fingerprint(page), {})
+        seen = results.get(classifier)
+        if seen is not None and reusable(seen):
+            return self.reuse_result(seen, page)
+        c = self.run_classifier(classifier, page, session)
+        if seen is None:
+            results[classifier] = c
+        return c
+
+    # Every classifier and filter run goes through these, so they can be
+    # timed when we're keeping metrics.
+    def run_classifier(self, classifier, page, session):
+        if self.metrics is None:
+            return classifier.classify_page(page, session)
+        started = time.perf_counter()
+        classification = classifier.classify_page(page, session)
+        self.metrics.observe_classifier(classification, time.perf_counter() - started)
+        return classification
+
+    # A classifier's result for an identical page, as this page's.
+    def reuse_result(self, classification, page):
+        logging.debug('Reused {} result for page {} from page {}'.format(
+            classification.classifier.slug(), page.page_id,
+            classification.subject.page_id))
+        if self.metrics is not None:
+            self.metrics.observe_reused(classification)
+        return classification.for_subject(page)
+
+    def run_filter(self, filt, session, pages):
+        if self.metrics is None:
+            return filt.filter(session, pages)
+        started = time.perf_counter()
+        keep, toss = filt.filter(session, pages)
+        self.metrics.observe_filter(filt, toss, time.perf_counter() - started)
+        return keep, toss
+
+    def finish_session(self, session, page_classifications):
+        if self.metrics is not None:
+            self.metrics.observe_pages(page_classifications)
+        if len(page_classifications) == 0:
             session_classification = Classification(session, self,
                     Classification.INCONCLUSIVE, 1.0)
         else:
-            for page in pages:
-                page_classifications.append(self.classify_page(page, session))
             session_classification = self.rollup_session(session, page_classifications)
-        return self.process_session_classification(session_classification)
+            if (len(self.pruned) > 0 and session_classification.is_down() and
+                    not any(looks_blocked(pc) for pc in page_classifications)):
+                restored = [self.classify_page(page, session)
+                        for page in self.blocked_pruned_pages(session)]
+                if len(restored) > 0:
+                    order = {page_id: i for i, page_id
+                            in enumerate(session.get_page_timestamps())}
+                    page_classifications = sorted(page_classifications + restored,
+                            key=lambda c: order[c.subject.page_id])
+                    session_classification = self.rollup_session(session,
+                            page_classifications)
+        session_classification = self.process_session_classification(session_classification)
+        if self.prune_stale_pages:
+            session_classification.details = {
+                    'pruned': [page.page_id for page in self.pruned]}
+        return session_classification
 
     def classify_async(self, session):
+        session = Session(session)
         pages = self.filtered_pages(session)
         page_classifications = []
         with concurrent.futures.ThreadPoolExecutor() as executor:
@@ -177,10 +399,27 @@ class ClassifyPipeline(Classifier):
 
     def filtered_pages(self, session):
         pages = session.get_pages()
+        if self.prune_stale_pages:
+            return self.pruned_filtered_pages(session, pages)
+        return self.run_filters(session, pages)
+
+    def stream_filtered_pages(self, session):
+        keep = lambda pages: (page for page in pages if self.passes_filters(session, page))
+        if self.prune_stale_pages:
+            page_ids = list(session.get_page_timestamps())
+            yield from self.iter_pruned_filtered_pages(session, page_ids,
+                    lambda ids: keep(session.iter_pages(ids)))
+            started = {page['id']: page['startedDateTime']
+                    for page in session['har']['log']['pages']}
+            self.pruned = [StoredPage(page_id, started[page_id]) for page_id in self.pruned]
+        else:
+            yield from keep(session.iter_pages())
+
+    def run_filters(self, session, pages):
         logging.debug('Begin filtering: {} pages'.format(len(pages)))
         for filt in self.filters:
             logging.debug('Running filter {}'.format(filt.name))
-            keep, toss = filt.filter(session, pages)
+            keep, toss = self.run_filter(filt, session, pages)
             self.filtered_out += zip(toss, [filt] * len(toss))
             pages = keep
         logging.debug('Finished filtering: {} pages'.format(len(pages)))
@@ -190,16 +429,211 @@ class ClassifyPipeline(Classifier):
                     self.filtered_out))))
         return pages
 
+    # The same as run_filters on a single page, for streaming.
+    def passes_filters(self, session, page):
+        for filt in self.filters:
+            _, toss = self.run_filter(filt, session, [page])
+            if len(toss) > 0:
+                logging.debug('Filtered out: {} by {} filter'.format(page.page_id, filt.name))
+                self.filtered_out.append((StoredPage(page.page_id, page.startedDateTime), filt))
+                return False
+        return True
+
+    # Pages older than the look-back window get no weight in rollup_session,
+    # so there's no point filtering or classifying them. The window is measured
+    # from the newest page that survives filtering, which we don't know until
+    # we've filtered. So walk back from the newest page one window at a time
+    # until something survives, then filter everything within the window of
+    # that page and prune the rest.
+    # Pruned pages can still mark a down session blocked in post-processing -
+    # see blocked_pruned_pages.
+    def pruned_filtered_pages(self, session, pages):
+        by_id = {page.page_id: page for page in pages}
+        kept = list(self.iter_pruned_filtered_pages(session, list(by_id),
+            lambda ids: self.run_filters(session, [by_id[i] for i in ids])))
+        self.pruned = [by_id[page_id] for page_id in self.pruned]
+        order = {page.page_id: i for i, page in enumerate(pages)}
+        return sorted(kept, key=lambda p: order[p.page_id])
+
+    # Pruned pages get no weight in the verdict, but BlockedFinder marks a down
+    # session blocked if any of its pages looks blocked, however old. So when
+    # a session is down and none of the pages we kept look blocked, this finds
+    # the pruned pages that survive filtering and that a classifier able to
+    # say a page is blocked says is. They're taken off self.pruned.
+    def blocked_pruned_pages(self, session):
+        blockers = [c for c in self.classifiers
+                if type(c).is_page_blocked is not Classifier.is_page_blocked]
+        blocked = []
+        for page in session.iter_pages([p.page_id for p in self.pruned]):
+            if not self.passes_filters(session, page): continue
+            if any(self.run_classifier(c, page, session).is_blocked() for c in blockers):
+                blocked.append(page)
+        if len(blocked) > 0:
+            logging.info('Kept {} pruned pages that look blocked'.format(len(blocked)))
+            ids = set(page.page_id for page in blocked)
+            self.pruned = [p for p in self.pruned if p.page_id not in ids]
+        return blocked
+
+    # Yields the pages that survive filtering, newest first. filter_pages
+    # takes a list of page IDs and returns the pages that survive. Leaves the
+    # IDs of pruned pages in self.pruned.
+    def iter_pruned_filtered_pages(self, session, page_ids, filter_pages):
+        window = self.look_back_days * 24 * 60 * 60
+        timestamps = session.get_page_timestamps()
+        by_age = sorted(page_ids, key=timestamps.get, reverse=True)
+        newest, i = None, 0
+        while i < len(by_age):
+            start = timestamps[by_age[i]] if newest is None else newest
+            j = i
+            while (j < len(by_age) and
+                    start - timestamps[by_age[j]] < window):
+                j += 1
+            if j == i: break
+            for page in filter_pages(by_age[i:j]):
+                # Pages come newest first, so the first survivor is the newest.
+                if newest is None:
+                    newest = timestamps[page.page_id]
+                yield page
+            i = j
+        self.pruned = by_age[i:]
+        if len(self.pruned) > 0:
+            logging.info('Pruned {} pages older than {} days: {}'.format(
+                len(self.pruned), self.look_back_days, self.pruned))
+
+    # Turns a stored session result back into a classification tree that
+    # points at this session's pages and this pipeline's classifiers.
+    def restore_session_classification(self, d, session):
+        pages = {page.page_id: page for page in session.get_pages()}
+        page_classifications = None
+        if 'constituents' in d:
+            page_classifications = []
+            for pd in d['constituents']:
+                page = pages[pd['subject']]
+                page_classifications.append(Classification.from_dict(pd, page,
+                    self, self.restore_constituents(pd, page)))
+        return Classification.from_dict(d, session, self, page_classifications)
+
+    def restore_constituents(self, page_dict, page):
+        classifiers = {c.slug(): c for c in self.classifiers}
+        constituents = []
+        for cd in page_dict['constituents']:
+            if cd['classifier'] not in classifiers:
+                raise ValueError('Stored result is from classifier "{}", which '
+                        'is not in this pipeline'.format(cd['classifier']))
+            constituents.append(Classification.from_dict(cd, page,
+                classifiers[cd['classifier']]))
+        return constituents
+
+    # Rescores a stored result (the output of as_dict) after classifiers have
+    # changed. Only classifiers whose version differs from the stored one (or
+    # that are new to the pipeline) are run again; everything else is reused
+    # and then rolled up again. The pages are the ones in the stored result, so
+    # filters are not rerun.
+    def rerun_changed_classifiers(self, stored, session):
+        session = Session(session)
+        if 'constituents' not in stored:
+            return Classification.from_dict(stored, session, self)
+        pages = {page.page_id: page for page in session.get_pages()}
+        rerun_counts = {c.slug(): 0 for c in self.classifiers}
+        page_classifications = []
+        for pd in stored['constituents']:
+            if pd['subject'] not in pages:
+                raise ValueError('Stored page "{}" is not in the session'.format(
+                    pd['subject']))
+            page = pages[pd['subject']]
+            versions = {cd['classifier']: cd for cd in pd['constituents']}
+            constituents = []
+            for classifier in self.classifiers:
+                cd = versions.get(classifier.slug())
+                if cd is not None and cd['version'] == classifier.version:
+                    constituents.append(Classification.from_dict(cd, page, classifier))
+                else:
+                    constituents.append(self.run_classifier(classifier, page, session))
+                    rerun_counts[classifier.slug()] += 1
+            page_classifications.append(self.rollup_single_page(page, constituents))
+        logging.info('Reran classifiers on {} pages: {}'.format(
+            len(page_classifications), rerun_counts))
+        session_classification = self.rollup_session(session, page_classifications)
+        return self.process_session_classification(session_classification)
+
+    # Everything classify_incremental needs to update a result later: the
+    # result itself, when each page was loaded (for rollup weighting), and
+    # every page's errors and vantage point (for checks across the session,
+    # which see filtered out pages too).
+    def session_state(self, classification):
+        return {
+                'result': classification.as_dict(),
+                'startedDateTimes': {c.subject.page_id: c.subject.startedDateTime
+                    for c in classification.get_constituents() or []},
+                'pageDetail': self.stored_page_details(classification.subject),
+                }
+
+    def stored_page_details(self, session):
+        if not isinstance(session, Session): return {}
+        details = {}
+        for page_id in session.get_page_ids():
+            d = session.get_page_details(page_id)
+            if d is not None:
+                details[page_id] = {k: d[k] for k in STORED_PAGE_DETAILS if k in d}
+        return details
+
+    def load_session_state(self, state):
+        page_classifications = []
+        for pd in state['result'].get('constituents', []):
+            page = StoredPage(pd['subject'], state['startedDateTimes'][pd['subject']])
+            page_classifications.append(self.rollup_single_page(page,
+                self.restore_constituents(pd, page)))
+        return page_classifications
+
+    # Updates a previous result (a Classification from classify, or the output
+    # of session_state) with a session containing only new pages. Only the new
+    # pages are filtered and classified; old pages keep their stored
+    # classifier results and are just rolled up again with the new ones. Pages
+    # that appear in both replace the stored ones.
+    # Old pages' errors and vantage points are kept in the state, so checks
+    # that look across the whole session (like ErrorClassifier's country
+    # rules) see every page, and are run again on the old pages. Classifiers
+    # that need a baseline need the baseline page included with the new pages,
+    # and only new pages are pruned.
+    def classify_incremental(self, previous, session):
+        started = time.perf_counter()
+        session = Session(session)
+        if isinstance(previous, Classification):
+            session.add_stored_page_details(self.stored_page_details(previous.subject))
+            old = [self.rollup_single_page(c.subject, list(c.get_constituents()))
+                    for c in previous.get_constituents() or []]
+        else:
+            session.add_stored_page_details(previous.get('pageDetail', {}))
+            old = self.load_session_state(previous)
+        new = [self.classify_page(page, session)
+                for page in self.filtered_pages(session)]
+        new_ids = set([c.subject.page_id for c in new])
+        page_classifications = [self.rerun_across_session(c, session) for c in old
+                if c.subject.page_id not in new_ids] + new
+        classification = self.finish_session(session, page_classifications)
+        if self.metrics is not None:
+            self.metrics.observe_session(classification, time.perf_counter() - started)
+        return classification
+
+    # Runs the classifiers that look across the session again on an old page,
+    # now that the session has more pages.
+    def rerun_across_session(self, page_classification, session):
+        page = page_classification.subject
+        if session.get_page_details(page.page_id) is None:
+            return page_classification # from a state without page details
+        return self.rollup_single_page(page, [
+            self.run_classifier(c.classifier, page, session)
+            if c.classifier.looks_across_session else c
+            for c in page_classification.get_constituents()])
+
     def process_session_classification(self, sc):
         for pp in self.post_processors:
             sc = pp.process(sc)
         return sc
 
     def classify_page(self, page, session):
-        constituents = []
-        for classifier in self.classifiers:
-            constituents.append(classifier.classify_page(page, session))
-        return self.rollup_single_page(page, constituents)
+        return self.rollup_single_page(page, [self.classify_page_with(classifier, page, session)
+            for classifier in self.classifiers])
 
     # There are up, down, and inconclusive classifications for each page, each
     # with a different classifier. This eliminates the inconclusive, weighs the
@@ -238,35 +672,41 @@ class ClassifyPipeline(Classifier):
 
     # We need to pool page confidences into a single session classification.
     # Intuitively, more recent requests should count more than older requests,
-    # and one down test should count more than one up test.
+    # and one down test should count more than one up test. Inconclusive pages
+    # carry no confidence, so they don't count at all.
     def rollup_session(self, session, page_classifications):
         classification = Classification(session, self,
                 constituents=page_classifications)
-        total_conf = 0.0
-        total_weight = 0.0
-        most_recent = max([dateutil.parser.parse(p.subject.startedDateTime) for p in
-            page_classifications])
-        for c in page_classifications:
-            weight = self.classification_weight(c, most_recent)
-            conf = c.confidence * weight
-            if c.is_down(): conf *= -1.0
-            total_conf += conf
-            total_weight += weight
+        weights = self.classification_weights(session, page_classifications)
+        confs = np.array([0.0 if c.is_inconclusive() else c.confidence
+            for c in page_classifications])
+        signs = np.array([-1.0 if c.is_down() else 1.0
+            for c in page_classifications])
+        total_weight = weights.sum()
+        if total_weight == 0:
+            classification.mark_inconclusive(NotEnoughDataError('No conclusive pages'))
+            return classification
+        total_conf = (confs * weights * signs).sum()
         if total_conf < 0:
-            classification.mark_down(total_conf * -1 / total_weight)
+            classification.mark_down(float(total_conf * -1 / total_weight))
         else:
-            classification.mark_up(total_conf / total_weight)
+            classification.mark_up(float(total_conf / total_weight))
         return classification
 
-    def classification_weight(self, c, now):
-        down_vs_up_weight = 1.5
-        look_back_days = 60
-        weight_from_status = 1.0 if c.is_up() else down_vs_up_weight
-        seconds_old = (now - dateutil.parser.parse(c.subject.startedDateTime)).total_seconds()
-        domain = [look_back_days * 24 * 60 * 60 * -1, 0.0]
+    # Computes every page's weight in one pass. Timestamps were parsed when
+    # the session loaded its pages.
+    def classification_weights(self, session, page_classifications):
+        times = np.array([session.get_page_timestamp(c.subject)
+            for c in page_classifications])
+        seconds_old = times.max() - times
+        from_status = np.array([
+            0.0 if c.is_inconclusive() else
+            1.0 if c.is_up() else self.down_vs_up_weight
+            for c in page_classifications])
+        domain = [self.look_back_days * 24 * 60 * 60 * -1, 0.0]
         rang = [0.0, 1.0]
-        weight_from_age = self.interpolate(domain, rang, -1 * seconds_old)
-        return weight_from_status * weight_from_age
+        from_age = np.interp(-1 * seconds_old, domain, rang)
+        return from_status * from_age
 
     def normalize_weights(self, classifiers):
         normed = self.normalize([w for _, w in classifiers])
@@ -300,12 +740,28 @@ class ClassifyPipeline(Classifier):
         # Clip to range
         return min([max([rang[0], x * slope + intercept]), rang[1]])
 
+# Stands in for a HAR page that we only know about from a stored result.
+# What session_state keeps from each page's details
+STORED_PAGE_DETAILS = ('errors', 'countryCode', 'asn')
+
+class StoredPage:
+    def __init__(self, page_id, startedDateTime):
+        self.page_id = page_id
+        self.startedDateTime = startedDateTime
+
 class Session:
     def __init__(self, data):
         self.data = data
         self.url = self['url']
         self.pages = None
+        self.page_timestamps = {}
+        self.page_results = {}
+        self.page_fingerprints = {}
+        self.derived = {}
         self.baseline = None
+        # Pages from an earlier result that aren't in this session's HAR, but
+        # whose details are - see add_stored_page_details.
+        self.stored_page_ids = []
 
     def __iter__(self):
         return self.data.__iter__()
@@ -330,7 +786,7 @@ class Session:
 
     def get_baseline(self):
         if self.baseline: return self.baseline
-        for page in self.get_pages():
+        for page in self.iter_pages():
             if page.page_id == self.get_baseline_id():
                 self.baseline = page
                 return self.baseline
@@ -340,13 +796,103 @@ class Session:
         if self.pages: return self.pages
         try:
             if 'har' not in self: return []
-            har_parser = HarParser(self['har'])
-            self.pages = har_parser.pages
+            self.pages = list(iter_pages(self['har'], self.get_page_entries()))
+            self.page_timestamps = {p.page_id: parse_timestamp(p.startedDateTime)
+                    for p in self.pages}
             return self.pages
         except Exception as e:
             logging.warning('Saw exception when parsing HAR: {}'.format(e))
             return []
 
+    def get_page_entries(self):
+        return self.get_derived('page_entries', lambda s: group_entries(s['har']))
+
+    # Like get_pages, but builds pages as they're asked for and doesn't keep
+    # them, so a caller working through a huge session a page at a time only
+    # ever holds one. Pages come in the same order as get_pages, or in the
+    # order of page_ids if given.
+    def iter_pages(self, page_ids=None):
+        if self.pages:
+            if page_ids is None:
+                yield from self.pages
+            else:
+                pages = {page.page_id: page for page in self.pages}
+                yield from (pages[page_id] for page_id in page_ids)
+            return
+        try:
+            if 'har' not in self: return
+            for page in iter_pages(self['har'], self.get_page_entries(), page_ids):
+                self.get_page_timestamp(page)
+                yield page
+        except Exception as e:
+            logging.warning('Saw exception when parsing HAR: {}'.format(e))
+
+    # Every page's start time, in seconds since the epoch, without building
+    # the pages.
+    def get_page_timestamps(self):
+        if 'har' in self:
+            for page in self['har']['log'].get('pages', []):
+                if page['id'] not in self.page_timestamps:
+                    self.page_timestamps[page['id']] = parse_timestamp(
+                            page['startedDateTime'])
+        return self.page_timestamps
+
+    # Memoizes data derived from the session (indexes and the like) that
+    # classifiers and filters would otherwise rebuild for every page.
+    # Adds the details of pages from an earlier result (see
+    # ClassifyPipeline.session_state), for those that aren't in this session.
+    def add_stored_page_details(self, details):
+        page_ids = set(page.page_id for page in self.iter_pages())
+        stored = {page_id: d for page_id, d in details.items() if page_id not in page_ids}
+        self.data = dict(self.data, pageDetail=dict(self.data.get('pageDetail', {}), **stored))
+        self.stored_page_ids = list(stored)
+
+    # The IDs of the HAR's pages and of any stored pages.
+    def get_page_ids(self):
+        return [page.page_id for page in self.iter_pages()] + self.stored_page_ids
+
+    def get_derived(self, key, build):
+        if key not in self.derived:
+            self.derived[key] = build(self)
+        return self.derived[key]
+
+    def get_content_hash(self):
+        content = json.dumps(self.data, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get_page_timestamp(self, page):
+        if page.page_id not in self.page_timestamps:
+            self.page_timestamps[page.page_id] = parse_timestamp(page.startedDateTime)
+        return self.page_timestamps[page.page_id]
+
+    # Hashes everything about a page that classifiers look at except timings:
+    # its entries' URLs, statuses, headers and bodies, and its errors and
+    # vantage point. Headers that change on every response and that no
+    # classifier reads are left out so identical responses match.
+    VOLATILE_HEADERS = ('date', 'expires', 'age', 'set-cookie')
+
+    def get_page_fingerprint(self, page):
+        if page.page_id not in self.page_fingerprints:
+            self.page_fingerprints[page.page_id] = self.compute_page_fingerprint(page)
+        return self.page_fingerprints[page.page_id]
+
+    def compute_page_fingerprint(self, page):
+        h = hashlib.sha1()
+        details = self.get_page_details(page.page_id) or {}
+        h.update(repr((details.get('errors'), details.get('countryCode'),
+            details.get('asn'))).encode('utf-8'))
+        for entry in page.entries:
+            response = entry['response']
+            content = response.get('content', {})
+            headers = [(header['name'], header['value'])
+                    for header in response.get('headers', [])
+                    if header['name'].lower() not in self.VOLATILE_HEADERS]
+            h.update(repr((entry is page.actual_page, entry['request']['url'],
+                response.get('status'), headers, content.get('size'),
+                content.get('encoding'))).encode('utf-8'))
+            h.update(content.get('text', '').encode('utf-8'))
+        return h.hexdigest()
+
     def get_page_details(self, page_id):
         if page_id not in self['pageDetail']:
             return None
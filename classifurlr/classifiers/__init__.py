@@ -3,6 +3,7 @@ from .cosine_similarity import CosineSimilarityClassifier
 from .differing_domain import DifferingDomainClassifier
 from .empty_page import EmptyPageClassifier
 from .error import ErrorClassifier
+from .near_duplicate import NearDuplicateBlockpageClassifier, BlockpageIndex
 from .page_length import PageLengthClassifier
 from .status_code import StatusCodeClassifier
 from .throttle import ThrottleClassifier
@@ -2,10 +2,27 @@ import re, logging
 
 from ..classification import Classifier, NotEnoughDataError
 from ..url_utils import extract_domain
-from ..har_utils import har_entry_response_content
+from ..har_utils import DEFAULT_SCAN_WINDOW, scan_window_version
+from ..entry_index import EntryIndex
+from .signatures import SignatureDatabase
+
+class PageEntryIndex:
+    def __init__(self, page, domains, entry_index):
+        self.page = page
+        self.domains = domains
+        self.entries = [entry_index.get(entry) for entry in page.entries]
+        self.bodies = {}
+
+    # Several checks read the same bodies, so they're kept for as long as
+    # this page is being checked.
+    def body(self, entry, limit=None):
+        key = (id(entry), limit)
+        if key not in self.bodies:
+            self.bodies[key] = entry.body(limit)
+        return self.bodies[key]
 
 class BlockpageSignatureClassifier(Classifier):
-    def __init__(self):
+    def __init__(self, signatures=None, scan_window=DEFAULT_SCAN_WINDOW):
         Classifier.__init__(self)
         self.name = 'Block page signature'
         self.desc = ('Uses text patterns found in pre-identified block pages '
@@ -13,195 +30,129 @@ class BlockpageSignatureClassifier(Classifier):
 
         # Some signatures from https://github.com/TheTorProject/ooni-pipeline/blob/master/pipeline/batch/sql_tasks.py
         # Others from ICLab https://github.com/iclab/iclab-dmp/blob/master/primitives/block_page_detection.py
-        # And others we found ourselves
+        # And others we found ourselves. They live in data/block_page_signatures.json.
 
         #TODO: (I've attempted all these, but failed.)
         # Find blockpage for Azerbaijan
         # Develop metric for Ethiopia (looks like 403s from "nginx" server)
         # Myanmar block page - look at OONI report
 
-        self.url_patterns = [
-'https?:\/\/www\.anonymous\.com\.bh',                                                      # BH
-'https?:\/\/nba\.com\.cy\/Eas\/eas\.nsf\/All\/6F7F17A7790A55C8C2257B130055C86F',           # CY
-'https?:\/\/www\.gamingcommission\.gov\.gr\/index\.php\/forbidden\-access\-black\-list\/', # GR
-'https?:\/\/internet\-positif\.org',                                                        # ID
-'https?:\/\/www\.airtel\.in\/dot\/',                                                       # IN
-'https?:\/\/10\.10',                                                                       # IR
-'https?:\/\/peyvandha\.ir',                                                                # IR
-'https?:\/\/warning\.or\.kr',                                                              # KR
-'https?:\/\/block\-no\.altibox\.net\/',                                                     # NO
-'https?:\/\/block\.om\/',                                                                  # OM
-'https?:\/\/mobilegen\.vodafone\.pt\/denied\/dn',                                          # PT
-'https?:\/\/www\.vodafone\.qa\/alu\.cfm',                                                  # QA
-'https?:\/\/eais\.rkn\.gov\.ru\/',                                                         # RU
-'https?:\/\/warning\.rt\.ru',                                                              # RU
-'https?:\/\/www\.atlex\.ru\/block\.html',                                                  # RU
-'https?:\/\/block\.acs\-group\.net\.ru\/block\/',                                           # RU
-'https?:\/\/blackhole\.beeline\.ru\/.*',                                                   # RU
-'https?:\/\/128\.204\.240\.1',                                                             # SA
-'https?:\/\/196\.29\.164\.27\/ntc\/ntcblock\.html',                                        # SD
-'https?:\/\/196\.1\.211\.6:8080\/alert\/',                                                 # SD
-'https?:\/\/www\.starhub\.com\/mda\-blocked\/01\.html',                                     # SG
-'https?:\/\/103\.208\.24\.21',                                                             # TH
-'https?:\/\/blocked\.nb\.sky\.com',                                                        # UK
-
-"https?:\/\/(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?:\:[0-9]{2,5})?\/webadmin\/deny\/",             # NetSweeper
-"https?:\/\/(?:[0-9]{1,3}\.){3}[0-9]{1,3}(?:\:[0-9]{2,5})?\/blocked\.html",
-]
-
-
-        self.body_fingerprints = [
-re.escape('that is considered illegal according to Belgian legislation'),        # BE
-re.escape('This web site has been blocked for violating regulations and '
-    'laws of Kingdom of Bahrain.'),                                              # BH
-re.escape('lagt at blokere for adgang til siden.'),                              # DK
-re.escape('xtpage = "page-blocage-terrorisme"'),                                 # FR
-re.escape('14. pontja, illetve 36/G'),                                           # HU
-re.escape('access to this page is blocked due to Communication and '
-    'Informatics Ministerial Decree Number 19/2014 regarding Internet Safe'),    # ID
-re.escape('The page you have requested has been blocked'),                       # IN
-re.escape('Your requested url has been blocked as per the directions '
-    'received from Department of Telecommunications,Government of India.'),      # IN
-re.escape('Your requested URL has been blocked as per the directions received '
-    'from Department of Telecommunications, Government of India.'),              # IN
-re.escape('GdF Stop Page'),                                                      # IT
-re.escape('<meta name="kcsc" content="blocking" />'),                            # KR
-re.escape('قد حجب الموقع بناء لأمر القضاء اللبناني'),                             # LB
-re.escape('This website is not available in Malaysia as it violate'),            # MY
-re.escape('prohibited for viewership from within Pakistan'),                     # PK
-re.escape('page should not be blocked please '
-    '<a href="http://www.internet.gov.sa/'),                                     # SA
-re.escape('it contravenes the Broadcasting (Class Licence) Notification '
-    'issued by the Info-communications Media Development Authority'),            # SG
-re.escape('access is restricted by the Media Development Authority'),            # SG
-re.escape('ถูกระงับโดยกระทรวงดิจิทัลเพื่อเศรษฐกิจและสังคม'),                              # TH
-re.escape('could have an affect on or be against the security of the Kingdom, '
-    'public order or good morals.'),                                             # TH
-re.escape('<title>Telekomünikasyon İletişim Başkanlığı</title>'),                # TR
-re.escape("The url has been blocked"),
-]
-
-        # These are countries for which we detect blocking by looking for certain
-        # header values.
-        self.header_fingerprints = [
-                ('Server', 'Protected by WireFilter'), # SA
-                ('Via', re.escape('1.1 C1102')),       # UZ
-                ]
-
-
-    def contains_bad_iframe(self, page, session):
-        domains = self.get_domains_that_constitute_blocked(page, session)
-        for e in page.entries:
-            body = har_entry_response_content(e)
-            entry_domain = extract_domain(e['request']['url'])
-            for url in self.url_patterns:
-                fprint = 'iframe [^>]* src=["\']{}'.format(url)
-                match = re.search(fprint, body)
+        self.signatures = signatures or SignatureDatabase.shared()
+        # Body checks only look at this many leading characters of each
+        # entry (None means the whole body). Signatures that can show up
+        # anywhere go in a "body_text_full_scan" list in the signature file.
+        self.scan_window = scan_window
+        self.expensive = True
+
+    # Results depend on the signatures as much as the code, so the signature
+    # file's version is part of ours.
+    @property
+    def version(self):
+        return scan_window_version('{}+{}'.format(self.code_version,
+            self.signatures.version), self.scan_window)
+
+    @version.setter
+    def version(self, value):
+        self.code_version = value
+
+    def contains_bad_iframe(self, index, signatures):
+        for entry in index.entries:
+            body = index.body(entry, self.scan_window)
+            if body is None: continue
+            for fprint in signatures.iframe_patterns:
+                match = fprint.search(body)
                 if match is not None:
-                    if entry_domain in domains:
+                    if entry.domain in index.domains:
                         logging.debug('{} - Page: {} - Body Pattern: "{}" '
-                                '- Matched: "{}"'.format(self.slug(), page.page_id,
-                                    fprint, match.group(0)))
+                                '- Matched: "{}"'.format(self.slug(), index.page.page_id,
+                                    fprint.pattern, match.group(0)))
                         return True
                     else:
                         logging.warning('{} - Saw different domain blocked! - '
                                 'Requested domains: {} - Blocked domain: {} - '
                                 'Body Pattern: "{}" - Matched: "{}"'.format(
-                                    self.slug(), domains, entry_domain, fprint,
-                                    match.group(0)))
+                                    self.slug(), index.domains, entry.domain,
+                                    fprint.pattern, match.group(0)))
         return False
 
-    def contains_bad_redirect(self, page, session):
-        domains = self.get_domains_that_constitute_blocked(page, session)
-        for entry in page.entries:
-            entry_domain = extract_domain(entry['request']['url'])
-            for header in entry['response']['headers']:
-                for url in self.url_patterns:
-                    if (header['name'] == 'Location' and
-                            re.search(url, header['value'])):
-                        if entry_domain in domains:
-                            logging.debug('{} - Page: {} - Header Pattern: "{}" - '
-                                'Header: "{}" - Value: "{}"'.format(self.slug(),
-                                    page.page_id, fprint[1], header['name'],
-                                    header['value']))
-                            return True
-                        else:
-                            logging.warning('{} - Saw different domain blocked! - '
-                                'Requested domains: {} - Blocked domain: {} - '
-                                    'Page: {} - Header Pattern: "{}" - '
-                                'Header: "{}" - Value: "{}"'.format(self.slug(),
-                                    domains, entry_domain, page.page_id,
-                                    fprint[1], header['name'],
-                                    header['value']))
+    def contains_bad_redirect(self, index, signatures):
+        for entry in index.entries:
+            for location in entry.locations:
+                for url in signatures.url_patterns:
+                    if not url.search(location): continue
+                    if entry.domain in index.domains:
+                        logging.debug('{} - Page: {} - Header Pattern: "{}" - '
+                            'Header: "Location" - Value: "{}"'.format(self.slug(),
+                                index.page.page_id, url.pattern, location))
+                        return True
+                    else:
+                        logging.warning('{} - Saw different domain blocked! - '
+                            'Requested domains: {} - Blocked domain: {} - '
+                                'Page: {} - Header Pattern: "{}" - '
+                            'Header: "Location" - Value: "{}"'.format(self.slug(),
+                                index.domains, entry.domain, index.page.page_id,
+                                url.pattern, location))
         return False
 
-    def contains_bad_body_text(self, page, session):
-        domains = self.get_domains_that_constitute_blocked(page, session)
-        for e in page.entries:
-            body = har_entry_response_content(e)
-            entry_domain = extract_domain(e['request']['url'])
-            for fprint in self.body_fingerprints:
-                match = re.search(fprint, body)
+    def contains_bad_body_text(self, index, signatures):
+        for entry in index.entries:
+            body = index.body(entry, self.scan_window)
+            if body is None: continue
+            fprints = [(fprint, body) for fprint in signatures.body_patterns]
+            if len(signatures.full_body_patterns) > 0:
+                full_body = index.body(entry)
+                fprints += [(fprint, full_body) for fprint in signatures.full_body_patterns]
+            for fprint, text in fprints:
+                match = fprint.search(text)
                 if match is not None:
-                    if entry_domain in domains:
+                    if entry.domain in index.domains:
                         logging.debug('{} - Page: {} - Body Pattern: "{}" '
-                                '- Matched: "{}"'.format(self.slug(), page.page_id,
-                                    fprint, match.group(0)))
+                                '- Matched: "{}"'.format(self.slug(), index.page.page_id,
+                                    fprint.pattern, match.group(0)))
                         return True
                     else:
                         logging.warning('{} - Saw different domain blocked! - '
                                 'Requested domains: {} - Blocked domain: {} - '
                                 'Body Pattern: "{}" - Matched: "{}"'.format(
-                                    self.slug(), domains, entry_domain, fprint,
-                                    match.group(0)))
+                                    self.slug(), index.domains, entry.domain,
+                                    fprint.pattern, match.group(0)))
         return False
 
-    def contains_bad_header(self, page, session):
-        domains = self.get_domains_that_constitute_blocked(page, session)
-        for entry in page.entries:
-            entry_domain = extract_domain(entry['request']['url'])
-            for header in entry['response']['headers']:
-                for fprint in self.header_fingerprints:
-                    if (header['name'] == fprint[0] and
-                            re.search(fprint[1], header['value'])):
-                        if entry_domain in domains:
-                            logging.debug('{} - Page: {} - Header Pattern: "{}" - '
-                                'Header: "{}" - Value: "{}"'.format(self.slug(),
-                                    page.page_id, fprint[1], header['name'],
-                                    header['value']))
-                            return True
-                        else:
-                            logging.warning('{} - Saw different domain blocked! - '
-                                'Requested domains: {} - Blocked domain: {} - '
-                                    'Page: {} - Header Pattern: "{}" - '
-                                'Header: "{}" - Value: "{}"'.format(self.slug(),
-                                    domains, entry_domain, page.page_id,
-                                    fprint[1], header['name'],
-                                    header['value']))
+    def contains_bad_header(self, index, signatures):
+        for entry in index.entries:
+            for name, fprint in signatures.header_patterns:
+                for value in entry.headers.get(name, []):
+                    if not fprint.search(value): continue
+                    if entry.domain in index.domains:
+                        logging.debug('{} - Page: {} - Header Pattern: "{}" - '
+                            'Header: "{}" - Value: "{}"'.format(self.slug(),
+                                index.page.page_id, fprint.pattern, name, value))
+                        return True
+                    else:
+                        logging.warning('{} - Saw different domain blocked! - '
+                            'Requested domains: {} - Blocked domain: {} - '
+                                'Page: {} - Header Pattern: "{}" - '
+                            'Header: "{}" - Value: "{}"'.format(self.slug(),
+                                index.domains, entry.domain, index.page.page_id,
+                                fprint.pattern, name, value))
         return False
 
-    def contains_request_for_bad_url(self, page, session):
+    def contains_request_for_bad_url(self, index, signatures):
         # We should only run this if we don't have any content as a last-ditch
         # effort to find blocked pages (where the bad URLs might be things like
         # iframes). Otherwise, this could give us a false positive in the case
         # of embedded content being blocked. This situation occurs with
         # header-only data.
-        entry_contents = []
-        for e in page.entries:
-            try:
-                entry_contents.append(har_entry_response_content(e))
-            except NotEnoughDataError:
-                entry_contents.append(None)
-        if not all([content is None for content in entry_contents]):
+        if any([entry.has_content for entry in index.entries]):
             return False
 
-        for e in page.entries:
-            for url in self.url_patterns:
-                match = re.search(url, e['request']['url'])
+        for entry in index.entries:
+            for url in signatures.url_patterns:
+                match = url.search(entry.url)
                 if match is not None:
                     logging.debug('{} - Page: {} - Pattern: "{}" '
-                            '- Matched: "{}"'.format(self.slug(), page.page_id,
-                                url, match.group(0)))
+                            '- Matched: "{}"'.format(self.slug(), index.page.page_id,
+                                url.pattern, match.group(0)))
                     return True
         return False
 
@@ -223,6 +174,10 @@ re.escape("The url has been blocked"),
         return None
 
     def page_down_confidence(self, page, session):
+        index = PageEntryIndex(page, self.get_domains_that_constitute_blocked(page, session),
+                EntryIndex.for_session(session))
+        signatures = self.signatures.for_country(
+                session.get_page_country_code(page.page_id))
         conditions = [
             self.contains_bad_iframe,
             self.contains_bad_redirect,
@@ -232,7 +187,7 @@ re.escape("The url has been blocked"),
             ]
         for is_true_for in conditions:
             try:
-                if is_true_for(page, session): return 1.0
+                if is_true_for(index, signatures): return 1.0
             except NotEnoughDataError:
                 continue
 
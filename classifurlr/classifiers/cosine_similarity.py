@@ -1,7 +1,7 @@
 import logging
 
 from ..classification import ClassifierWithBaseline, NotEnoughDataError
-from ..classifiers.similarity_metrics import similarity_metrics
+from ..classifiers.similarity_metrics import similarity_metrics, Document
 from ..har_utils import har_entry_response_content
 
 class CosineSimilarityClassifier(ClassifierWithBaseline):
@@ -13,16 +13,20 @@ class CosineSimilarityClassifier(ClassifierWithBaseline):
         self.page_length_threshold = 0.3019
         self.cosine_sim_threshold = 0.816
         self.dom_sim_threshold = 0.995
+        self.expensive = True
 
     def page_down_confidence(self, page, session):
         baseline = self.get_baseline(session)
-        baseline_content = har_entry_response_content(baseline.actual_page)
+        # Parsed once and compared with every page
+        baseline_document = session.get_derived('baseline_document', lambda s:
+                Document(har_entry_response_content(baseline.actual_page)))
         try:
             this_content = har_entry_response_content(page.actual_page)
         except NotEnoughDataError as e:
             raise NotEnoughDataError('Could not locate page '
                     'content for URL "{}"'.format(page.url)) from e
-        metrics = similarity_metrics(baseline_content, this_content)
+        metrics = similarity_metrics(baseline_document, this_content,
+                metrics=('cosine similarity',))
         logging.debug("{} - Page: {} - Metric: {}".format(self.slug(), page.page_id,
             round(metrics['cosine similarity'], 3)))
         return 1.0 if metrics['cosine similarity'] <= self.cosine_sim_threshold else 0.0
@@ -1,14 +1,20 @@
-from ..classification import Classifier
-from ..har_utils import get_total_size
+import numpy as np
 
-class EmptyPageClassifier(Classifier):
+from ..classification import NotEnoughDataError
+from ..features import FeatureClassifier
+
+class EmptyPageClassifier(FeatureClassifier):
     def __init__(self):
-        Classifier.__init__(self)
+        FeatureClassifier.__init__(self)
         self.name = 'Empty page'
         self.desc = 'A classifier that says pages with very little content are down'
         self.size_cutoff = 300 # bytes
 
-    def page_down_confidence(self, page, session):
-        total_size = get_total_size(page.entries)
-        return 1.0 if total_size <= self.size_cutoff else 0.0
+    def down_confidences(self, features):
+        total_size = features.total_size
+        return np.where(np.isnan(total_size), np.nan,
+                (total_size <= self.size_cutoff).astype(float))
 
+    def missing_data_error(self, page, session):
+        return NotEnoughDataError('Could not determine total size of page '
+                '"{}"'.format(page.page_id))
@@ -1,102 +1,85 @@
-import logging
+import collections, logging
 
 from ..classification import Classifier, NotEnoughDataError
 
-class ErrorClassifier(Classifier):
-    def __init__(self):
-        Classifier.__init__(self)
-        self.name = 'Error'
-        self.desc = 'Classifies all session that contain errors as down'
+# Errors that indicate blocking from certain vantage points. Each rule is
+# (country, ASNs or None for any, how many pages must see it, error).
+#   'all' - there's more than one page, and every page's first error
+#       contains the error text
+#   'many' - more than one page's first error is exactly the error text
+#   'any' - at least one page's first error is exactly the error text
+BLOCKING_ERROR_RULES = [
+        ('CN', None, 'all', 'Operation canceled'),
+        ('KZ', None, 'all', 'Operation canceled'),
+        ('LB', None, 'all', 'Connection closed'),
+        # More than one page must have the error. We have enough data for this.
+        ('TR', [197328], 'many', "(56, 'Recv failure: Connection reset by peer')"),
+        # Only need to see these once. Not great, but we don't have enough
+        # data otherwise.
+        ('IR', [48434], 'any', "(56, 'Recv failure: Connection reset by peer')"),
+        ('ID', [55699, 23700], 'any', "(52, 'Empty reply from server')"),
+        ]
 
-    def is_blocked_in_china(self, page, session, classification):
-        country = session.get_page_country_code(page.page_id)
-        if country is None or country != 'CN':
-            return None # None means we don't know if it's blocked or not
-        errors = [session.get_page_errors(p.page_id) for p in session.get_pages()]
-        # All pages must have the error, and there must be more than one page.
-        if errors is None or None in errors or [] in errors or len(errors) <= 1:
-            return None
-        errors = [e[0] for e in errors]
-        if all([e is not None and 'Operation canceled' in e for e in errors]):
-            return True
-        return None
+# Every page's errors and vantage point, gathered in one pass over the session.
+class SessionErrorIndex:
+    def __init__(self, session):
+        self.errors = {}
+        self.first_errors = []
+        self.vantages = {}
+        for page_id in session.get_page_ids():
+            errors = session.get_page_errors(page_id)
+            self.errors[page_id] = errors
+            self.first_errors.append(errors[0] if errors else None)
+            vantage = (session.get_page_country_code(page_id),
+                    session.get_page_asn(page_id))
+            self.vantages[page_id] = vantage
+        self.page_count = len(self.first_errors)
+        self.all_pages_have_errors = all([e for e in self.errors.values()])
+        self.first_error_counts = collections.Counter(self.first_errors)
+        self.rule_results = {}
 
-    def is_blocked_in_kazakhstan(self, page, session, classification):
-        country = session.get_page_country_code(page.page_id)
-        if country is None or country != 'KZ':
-            return None # None means we don't know if it's blocked or not
-        errors = [session.get_page_errors(p.page_id) for p in session.get_pages()]
-        # All pages must have the error, and there must be more than one page.
-        if errors is None or None in errors or [] in errors or len(errors) <= 1:
-            return None
-        errors = [e[0] for e in errors]
-        if all([e is not None and ('Operation canceled' in e) for e in errors]):
-            return True
-        return None
+    def get_vantage(self, page_id):
+        return self.vantages[page_id]
 
-    def is_blocked_in_lebanon(self, page, session, classification):
-        country = session.get_page_country_code(page.page_id)
-        if country is None or country != 'LB':
-            return None
-        errors = [session.get_page_errors(p.page_id) for p in session.get_pages()]
-        # All pages must have the error, and there must be more than one page.
-        if errors is None or None in errors or [] in errors or len(errors) <= 1:
-            return None
-        errors = [e[0] for e in errors]
-        if all([e is not None and ('Connection closed' in e) for e in errors]):
-            return True
-        return None
+    def matches(self, rule):
+        _, _, scope, error = rule
+        if scope == 'all':
+            return (self.page_count > 1 and self.all_pages_have_errors and
+                    all([e is not None and error in e for e in self.first_errors]))
+        if scope == 'many':
+            return self.first_error_counts[error] > 1
+        if scope == 'any':
+            return self.first_error_counts[error] > 0
+        raise ValueError('Unknown rule scope "{}"'.format(scope))
 
-    def is_blocked_in_turkey(self, page, session, classification):
-        asn = session.get_page_asn(page.page_id)
-        country = session.get_page_country_code(page.page_id)
-        if not (country == 'TR' and asn == 197328):
-            return None
-        errors = [session.get_page_errors(p.page_id) for p in session.get_pages()]
-        # More than one page must have the error. We have enough data for this.
-        if errors is None or len(errors) <= 1:
-            return None
-        errors = [e[0] for e in errors if e[0] == "(56, 'Recv failure: Connection reset by peer')"]
-        if len(errors) > 1:
-            return True
-        return None
+    # Rules only depend on the vantage point, so each one is evaluated once
+    # per (country, ASN) rather than once per page.
+    def is_blocked_from(self, vantage):
+        if vantage not in self.rule_results:
+            country, asn = vantage
+            self.rule_results[vantage] = None # None means we don't know
+            for rule in BLOCKING_ERROR_RULES:
+                if rule[0] != country: continue
+                if rule[1] is not None and asn not in rule[1]: continue
+                if self.matches(rule):
+                    self.rule_results[vantage] = True
+                    break
+        return self.rule_results[vantage]
 
-    def is_blocked_in_iran(self, page, session, classification):
-        asn = session.get_page_asn(page.page_id)
-        country = session.get_page_country_code(page.page_id)
-        if not (country == 'IR' and asn == 48434):
-            return None
-        errors = [session.get_page_errors(p.page_id) for p in session.get_pages()]
-        # Only need to see this error once. Not great, but we don't have enough data otherwise.
-        if errors is None or len(errors) == 0:
-            return None
-        errors = [e[0] for e in errors if e[0] == "(56, 'Recv failure: Connection reset by peer')"]
-        if len(errors) > 0:
-            return True
-        return None
+class ErrorClassifier(Classifier):
+    def __init__(self):
+        Classifier.__init__(self)
+        self.name = 'Error'
+        self.desc = 'Classifies all session that contain errors as down'
+        self.looks_across_session = True
 
-    def is_blocked_in_indonesia(self, page, session, classification):
-        asn = session.get_page_asn(page.page_id)
-        country = session.get_page_country_code(page.page_id)
-        if not (country == 'ID' and asn in [55699, 23700]):
-            return None
-        errors = [session.get_page_errors(p.page_id) for p in session.get_pages()]
-        # Only need to see this error once. Not great, but we don't have enough data otherwise.
-        if errors is None or len(errors) == 0:
-            return None
-        errors = [e[0] for e in errors if e[0] == "(52, 'Empty reply from server')"]
-        if len(errors) > 0:
-            return True
-        return None
+    def error_index(self, session):
+        return session.get_derived('error_index', SessionErrorIndex)
 
     def is_page_blocked(self, page, session, classification):
         if classification.is_up(): return False
-        return (self.is_blocked_in_china(page, session, classification) or
-                self.is_blocked_in_lebanon(page, session, classification) or
-                self.is_blocked_in_turkey(page, session, classification) or
-                self.is_blocked_in_indonesia(page, session, classification) or
-                self.is_blocked_in_iran(page, session, classification) or
-                self.is_blocked_in_kazakhstan(page, session, classification))
+        index = self.error_index(session)
+        return index.is_blocked_from(index.get_vantage(page.page_id))
 
     def page_down_confidence(self, page, session):
         errors = session.get_page_errors(page.page_id)
@@ -0,0 +1,202 @@
+import hashlib, logging, re, zlib
+
+import numpy as np
+
+from ..classification import Classifier, NotEnoughDataError
+from ..har_utils import har_entry_response_text, DEFAULT_SCAN_WINDOW, scan_window_version
+
+# Tags, words and numbers. Every run of digits is the same token, so
+# timestamps, request IDs and the like don't make pages look different.
+TOKEN = re.compile(r'<\s*(/?[a-zA-Z][\w-]*)|([^\W\d_]+)|\d+')
+
+def tokens(text):
+    for match in TOKEN.finditer(text):
+        tag, word = match.groups()
+        if tag is not None:
+            yield '<' + tag.lower()
+        elif word is not None:
+            yield word.lower()
+        else:
+            yield '0'
+
+# Overlapping runs of tokens, hashed. Mixing tags in with the words means
+# a block page translated into another language still shares its structure.
+def shingle_hashes(text, size=4):
+    toks = list(tokens(text))
+    if len(toks) < size:
+        runs = [toks] if toks else []
+    else:
+        runs = (toks[i:i + size] for i in range(len(toks) - size + 1))
+    return np.unique(np.array([zlib.crc32(' '.join(run).encode('utf-8'))
+        for run in runs], dtype=np.uint64))
+
+# MinHash sketches of known block pages, bucketed by locality-sensitive
+# hashing. Pages whose shingles mostly overlap (high Jaccard similarity) are
+# very likely to share a bucket in at least one band, so a lookup only
+# compares a page against the handful of references in its buckets rather
+# than all of them.
+class BlockpageIndex:
+    def __init__(self, num_perm=128, bands=16, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # Fixed seed, so sketches are comparable across processes and
+        # saved indexes.
+        random = np.random.RandomState(seed)
+        self.a = random.randint(1, 2**32, num_perm, dtype=np.uint64) | np.uint64(1)
+        self.b = random.randint(0, 2**32, num_perm, dtype=np.uint64)
+        self.seed = seed
+        self.ids = []
+        self.buckets = [{} for _ in range(bands)]
+        # New rows are stacked onto the matrix when it's next needed, not on
+        # every add.
+        self.stacked = np.empty((0, num_perm), dtype=np.uint32)
+        self.pending = []
+        self.digest = None
+
+    @property
+    def signatures(self):
+        if len(self.pending) > 0:
+            self.stacked = np.vstack([self.stacked] + self.pending)
+            self.pending = []
+        return self.stacked
+
+    # Multiply-shift hashing: one hash function per permutation, all applied
+    # at once. uint64 arithmetic wraps, which is what we want.
+    def sketch(self, text):
+        hashes = shingle_hashes(text)
+        if len(hashes) == 0:
+            return None
+        with np.errstate(over='ignore'):
+            permuted = (self.a[:, None] * hashes[None, :] + self.b[:, None]) >> np.uint64(32)
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signature):
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes()
+                for i in range(self.bands)]
+
+    def add(self, reference_id, text):
+        signature = self.sketch(text)
+        if signature is None:
+            raise ValueError('Reference page "{}" has no text'.format(reference_id))
+        self.add_signature(reference_id, signature)
+
+    def add_signature(self, reference_id, signature):
+        self.pending.append(signature)
+        self.index_row(reference_id, signature)
+
+    def index_row(self, reference_id, signature):
+        row = len(self.ids)
+        self.ids.append(reference_id)
+        for bucket, key in zip(self.buckets, self.band_keys(signature)):
+            bucket.setdefault(key, []).append(row)
+        self.digest = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Identifies the index's contents, for classifier versions.
+    def fingerprint(self):
+        if self.digest is None:
+            h = hashlib.sha1(repr((self.num_perm, self.bands, self.seed,
+                self.ids)).encode('utf-8'))
+            h.update(self.signatures.tobytes())
+            self.digest = h.hexdigest()[:12]
+        return '{}-{}'.format(len(self), self.digest)
+
+    # The most similar reference page sharing a bucket with the text, as
+    # (reference ID, estimated Jaccard similarity), or None.
+    def query(self, text):
+        signature = self.sketch(text)
+        if signature is None:
+            return None
+        return self.query_signature(signature)
+
+    def query_signature(self, signature):
+        candidates = set()
+        for bucket, key in zip(self.buckets, self.band_keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        if len(candidates) == 0:
+            return None
+        rows = np.array(sorted(candidates))
+        similarities = (self.signatures[rows] == signature).mean(axis=1)
+        best = similarities.argmax()
+        return self.ids[rows[best]], float(similarities[best])
+
+    def save(self, path):
+        np.savez_compressed(path, ids=np.array(self.ids, dtype=str),
+                signatures=self.signatures,
+                params=np.array([self.num_perm, self.bands, self.seed]))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            num_perm, bands, seed = data['params'].tolist()
+            index = cls(num_perm, bands, seed)
+            index.stacked = data['signatures']
+            for reference_id, signature in zip(data['ids'].tolist(), index.stacked):
+                index.index_row(reference_id, signature)
+        return index
+
+class NearDuplicateBlockpageClassifier(Classifier):
+    def __init__(self, index, threshold=0.8, scan_window=DEFAULT_SCAN_WINDOW):
+        Classifier.__init__(self)
+        self.name = 'Near duplicate block page'
+        self.desc = ('Detects pages that are near-duplicates of known block pages, '
+                'even if their text differs a little')
+        self.index = index
+        self.threshold = threshold # estimated Jaccard similarity
+        self.scan_window = scan_window
+        self.expensive = True
+
+    # Results depend on the reference pages and threshold as much as the code.
+    @property
+    def version(self):
+        return scan_window_version('{}+{}+{}'.format(self.code_version,
+            self.index.fingerprint(), self.threshold), self.scan_window)
+
+    @version.setter
+    def version(self, value):
+        self.code_version = value
+
+    def is_page_blocked(self, page, session, classification):
+        if classification.is_down(): return True
+        return None
+
+    # The reference page this page is a near-duplicate of, as (reference ID,
+    # similarity), or None.
+    def match(self, page, session):
+        return session.get_derived((self, 'match', page.page_id),
+                lambda s: self.find_match(page))
+
+    def find_match(self, page):
+        entry = page.actual_page
+        if entry is None:
+            raise NotEnoughDataError('No final page found')
+        signature = self.index.sketch(har_entry_response_text(entry, self.scan_window))
+        if signature is None:
+            raise NotEnoughDataError('No text to compare for URL '
+                    '"{}"'.format(entry['request']['url']))
+        match = self.index.query_signature(signature)
+        if match is None or match[1] < self.threshold:
+            return None
+        return match
+
+    def page_down_confidence(self, page, session):
+        match = self.match(page, session)
+        if match is None:
+            return 0.0
+        logging.debug('{} - Page: {} - Reference: "{}" - Similarity: {}'.format(
+            self.slug(), page.page_id, match[0], round(match[1], 3)))
+        return match[1]
+
+    # Says which known block page the page matched.
+    def classify_page(self, page, session):
+        classification = super().classify_page(page, session)
+        if classification.is_down():
+            reference_id, similarity = self.match(page, session)
+            classification.details = {'reference': reference_id,
+                    'similarity': round(similarity, 6)}
+        return classification
@@ -1,27 +1,56 @@
 import logging
 
+import numpy as np
+
 from ..classification import ClassifierWithBaseline, NotEnoughDataError
+from ..features import FeatureClassifier
 
-class PageLengthClassifier(ClassifierWithBaseline):
+class PageLengthClassifier(FeatureClassifier, ClassifierWithBaseline):
     def __init__(self):
         super().__init__()
         self.name = 'Page length'
         self.desc = 'Detects whether a page is a block page by page length given a baseline'
         self.page_length_threshold = 0.3019
 
-    def response_len(self, entry):
+    def length_ratios(self, features):
+        baseline_len = features.baseline_size
+        this_content_len = features.actual_size
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = (np.abs(baseline_len - this_content_len)
+                    / np.maximum(baseline_len, this_content_len))
+        # Both empty is as alike as pages get.
+        return np.where((baseline_len == 0) & (this_content_len == 0), 0.0, ratios)
+
+    def down_confidences(self, features):
+        ratios = self.length_ratios(features)
+        return np.where(np.isnan(ratios), np.nan,
+                (ratios >= self.page_length_threshold).astype(float))
+
+    def response_size_error(self, entry):
+        if entry is None:
+            return NotEnoughDataError('No final page found')
+        return NotEnoughDataError('Could not determine response '
+                'size for URL "{}"'.format(entry['request']['url']))
+
+    def missing_data_error(self, page, session):
         try:
-            return entry['response']['content']['size']
-        except KeyError as e:
-            raise NotEnoughDataError('Could not determine response '
-                    'size for URL "{}"'.format(entry['request']['url'])) from e
-
-    def page_down_confidence(self, page, session):
-        baseline = self.get_baseline(session)
-        baseline_len = self.response_len(baseline.actual_page)
-        this_content_len = self.response_len(page.actual_page)
-        length_ratio = abs(baseline_len - this_content_len) / max(baseline_len, this_content_len)
-        logging.debug("{} - Page: {} - Baseline: {} - Content: {} - Diff Ratio: {}".format(
-            self.slug(), page.page_id, baseline_len, this_content_len, round(length_ratio, 3)))
-        return 1.0 if length_ratio >= self.page_length_threshold else 0.0
+            baseline = self.get_baseline(session)
+        except NotEnoughDataError as e:
+            return e
+        for subject in (baseline, page):
+            try:
+                entry = subject.actual_page
+            except KeyError:
+                entry = None
+            if entry is None or not isinstance(entry['response'].get(
+                    'content', {}).get('size'), (int, float)):
+                return self.response_size_error(entry)
+        return NotEnoughDataError('Could not compare response sizes of page '
+                '"{}" and baseline'.format(page.page_id))
 
+    def log_page(self, page, session, features, i):
+        baseline_len, this_content_len = features.baseline_size[i], features.actual_size[i]
+        length_ratio = abs(baseline_len - this_content_len) / max(baseline_len, this_content_len, 1)
+        logging.debug("{} - Page: {} - Baseline: {} - Content: {} - Diff Ratio: {}".format(
+            self.slug(), page.page_id, int(baseline_len), int(this_content_len),
+            round(float(length_ratio), 3)))
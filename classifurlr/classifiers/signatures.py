@@ -0,0 +1,90 @@
+import json, logging, os, re, threading, time
+
+DEFAULT_SIGNATURE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+        'data', 'block_page_signatures.json')
+GLOBAL = 'global'
+
+# The compiled signatures to check a page against.
+class SignatureSet:
+    def __init__(self, buckets):
+        self.url_patterns = []
+        self.body_patterns = []
+        self.header_patterns = []
+        self.full_body_patterns = []
+        for bucket in buckets:
+            self.url_patterns += [re.compile(url) for url in bucket.get('urls', [])]
+            self.body_patterns += [re.compile(re.escape(text))
+                    for text in bucket.get('body_text', [])]
+            self.full_body_patterns += [re.compile(re.escape(text))
+                    for text in bucket.get('body_text_full_scan', [])]
+            self.header_patterns += [(name.lower(), re.compile(value))
+                    for name, value in bucket.get('headers', [])]
+        self.iframe_patterns = [re.compile('iframe [^>]* src=["\']{}'.format(url.pattern))
+                for url in self.url_patterns]
+
+# Block page signatures loaded from a versioned JSON file, bucketed by the
+# country they're seen in. Pages are checked against the signatures for the
+# country they were fetched from plus the "global" bucket. The file is checked
+# for changes at most every reload_interval seconds, so long-running processes
+# pick up new signatures without restarting.
+class SignatureDatabase:
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, path=DEFAULT_SIGNATURE_FILE, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked_at = 0.0
+        self.load()
+
+    # One database per file, shared by every classifier in the process.
+    @classmethod
+    def shared(cls, path=DEFAULT_SIGNATURE_FILE):
+        with cls._shared_lock:
+            if path not in cls._shared:
+                cls._shared[path] = cls(path)
+            return cls._shared[path]
+
+    def load(self):
+        mtime = os.path.getmtime(self.path)
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        countries = {code.upper() if code != GLOBAL else GLOBAL: bucket
+                for code, bucket in data['countries'].items()}
+        # Swap everything in at once so readers never see a half-loaded file.
+        self.state = (data['version'], countries, {})
+        self.mtime = mtime
+        logging.info('Loaded block page signatures version {} from {}'.format(
+            data['version'], self.path))
+
+    def reload_if_changed(self):
+        now = time.time()
+        if now - self.checked_at < self.reload_interval: return
+        with self.lock:
+            if now - self.checked_at < self.reload_interval: return
+            self.checked_at = now
+            try:
+                if os.path.getmtime(self.path) != self.mtime:
+                    self.load()
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning('Could not reload block page signatures from '
+                        '{}, keeping version {}: {}'.format(self.path, self.version, e))
+
+    @property
+    def version(self):
+        return self.state[0]
+
+    # If we don't know where the page was fetched from, check everything.
+    def for_country(self, country_code):
+        self.reload_if_changed()
+        version, countries, compiled = self.state
+        key = country_code.upper() if country_code else None
+        if key not in compiled:
+            if key is None:
+                buckets = list(countries.values())
+            else:
+                buckets = [countries.get(key, {}), countries.get(GLOBAL, {})]
+            compiled[key] = SignatureSet(buckets)
+        return compiled[key]
@@ -1,17 +1,26 @@
+import argparse
 from bs4 import BeautifulSoup
 import collections
+from collections.abc import Mapping
+from functools import cached_property
 from html.parser import HTMLParser
 import math
+import multiprocessing
 import numpy as np
+import os
 import sys
 import traceback
 import urllib.request, urllib.error
 
 
 class TagParser(HTMLParser):
-    cnt = collections.Counter()    # counter of  html tag frequency
     attr_list = [u'color', u'width', u'height']    # listed of interested signature attributes
 
+    def __init__(self):
+        # counter of html tag frequency, per parser so pages don't add up
+        self.cnt = collections.Counter()
+        super().__init__()
+
     def handle_starttag(self, tag, attributes):
         # extract attributes and their values into a single list if they appear in attr_list
         attr_with_value = [item for sub_list in
@@ -68,61 +77,100 @@ def length_ratio(page1, page2):
 
 
 def dom_similarity(page1, page2):
+    return document_dom_similarity(Document(page1), Document(page2))
+
+
+# compute all parent-child couples, or None if the page can't be parsed
+def get_dom_couples(content):
+    try:
+        dom = BeautifulSoup(content, 'html.parser')
+    except Exception as e:
+        return None
+    return collections.Counter((str(x.parent.name), str(x.name)) for x in dom.find_all())
+
+
+# Correlation of the two pages' DOM couple matrices. The matrices are sparse,
+# so only the couples that appear are counted.
+def document_dom_similarity(doc1, doc2):
     # return 1 if lab and field are identical
-    if page1 == page2:
+    if doc1.content == doc2.content:
         return 1.0
 
     # return 0 if one of the page is empty
-    if page1 is None or page2 is None:
+    if doc1.content is None or doc2.content is None:
         return 0.0
 
-    # compute all parent-child couples
-    tags = ['[document]']    # root tag for BeautifulSoup
-    couples_lab = []
-    couples_field = []
-    try:
-        dom1 = BeautifulSoup(page1, 'html.parser')
-        dom2 = BeautifulSoup(page2, 'html.parser')
-    except Exception as e:
-        return 0.0 # just say they're different 
-
-    for x in dom1.findAll():
-        couples_lab.append((str(x.parent.name), str(x.name)))
-        if str(x.name) not in tags:
-            tags.append(str(x.name))
-    for x in dom2.findAll():
-        couples_field.append((str(x.parent.name), str(x.name)))
-        if str(x.name) not in tags:
-            tags.append(str(x.name))
-
-    # compute DOM couples matrix
-    matrix1 = np.zeros((len(tags), len(tags)))
-    matrix2 = np.zeros((len(tags), len(tags)))
-    for c in couples_lab:
-        x = tags.index(c[0])
-        y = tags.index(c[1])
-        matrix1[x, y] += 1
-    for c in couples_field:
-        x = tags.index(c[0])
-        y = tags.index(c[1])
-        matrix2[x, y] += 1
-
-    correlation = np.vdot(matrix1, matrix2)
-    correlation /= np.linalg.norm(matrix1) * np.linalg.norm(matrix2)
-    return abs(correlation)
-
-
-def similarity_metrics(page1, page2):
-    vec1 = get_term_frequency_vectors(page1)
-    vec2 = get_term_frequency_vectors(page2)
-
-    results = {
-        'cosine similarity': cosine_similarity(vec1, vec2),
-        'equal weight': equal_weight(vec1, vec2),
-        'length ratio': length_ratio(page1, page2),
-        'dom similarity': dom_similarity(page1, page2)
-    }
-    return results
+    couples_lab, couples_field = doc1.dom_couples, doc2.dom_couples
+    if couples_lab is None or couples_field is None:
+        return 0.0 # just say they're different
+
+    correlation = sum(count * couples_field[c] for c, count in couples_lab.items()
+            if c in couples_field)
+    norms = (math.sqrt(sum(count**2 for count in couples_lab.values())) *
+            math.sqrt(sum(count**2 for count in couples_field.values())))
+    if not norms:
+        return 0.0
+    return abs(correlation / norms)
+
+
+# A page's content, with each view of it the metrics need (tag frequencies,
+# DOM couples) worked out the first time it's asked for. Pass the same
+# Document for a page that is compared again and again, like a baseline, and
+# it's only ever parsed once.
+class Document:
+    def __init__(self, content):
+        self.content = content
+
+    @cached_property
+    def term_frequencies(self):
+        return get_term_frequency_vectors(self.content)
+
+    @cached_property
+    def dom_couples(self):
+        return get_dom_couples(self.content)
+
+
+METRICS = {
+    'cosine similarity': lambda d1, d2: cosine_similarity(
+        d1.term_frequencies, d2.term_frequencies),
+    'equal weight': lambda d1, d2: equal_weight(
+        d1.term_frequencies, d2.term_frequencies),
+    'length ratio': lambda d1, d2: length_ratio(d1.content, d2.content),
+    'dom similarity': document_dom_similarity,
+}
+
+
+# The requested metrics for a pair of pages, as a read-only dict. Each metric
+# is only computed when it's first looked up.
+class SimilarityMetrics(Mapping):
+    def __init__(self, page1, page2, metrics=None):
+        self.doc1 = page1 if isinstance(page1, Document) else Document(page1)
+        self.doc2 = page2 if isinstance(page2, Document) else Document(page2)
+        self.names = tuple(METRICS) if metrics is None else tuple(metrics)
+        for name in self.names:
+            if name not in METRICS:
+                raise ValueError('Unknown similarity metric "{}"'.format(name))
+        self.values = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self.values:
+            self.values[name] = METRICS[name](self.doc1, self.doc2)
+        return self.values[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def similarity_metrics(page1, page2, metrics=None):
+    return SimilarityMetrics(page1, page2, metrics)
 
 
 def get_file_content(filename):
@@ -137,7 +185,7 @@ def get_file_content(filename):
         try:
             with open(filename, 'r') as file_p:
                 return file_p.read()
-        except IOError:
+        except IOError as exp:
             print("Error: cannot open %s" % filename, file=sys.stderr)
             raise exp
 
@@ -151,8 +199,97 @@ def compare_files(file1, file2):
     return similarity_metrics(page1, page2)
 
 
+# Corpus mode: every file's metrics against every other file's, for
+# clustering captured pages (like candidate block pages). Each file is
+# tokenized once, in a pool of worker processes, and the matrices are then
+# built with whole-array operations - the cosine matrix is a single matrix
+# product, which numpy spreads across cores.
+CORPUS_METRICS = ('cosine similarity', 'length ratio')
+# Only files with these extensions are picked up from directories, so saved
+# matrices and other stray files in a capture directory are left alone.
+CORPUS_EXTENSIONS = ('.html', '.htm')
+
+def corpus_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(root, name)
+                for root, _, names in os.walk(path) for name in names
+                if os.path.splitext(name)[1].lower() in CORPUS_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+# Returns None for files that aren't text.
+def tokenize_file(filename):
+    try:
+        content = get_file_content(filename)
+    except UnicodeDecodeError:
+        print("Warning: skipping %s, it isn't text" % filename, file=sys.stderr)
+        return None
+    return get_term_frequency_vectors(content), len(content)
+
+# Returns the file names and the cosine similarity and length ratio matrices,
+# in the same order as the files.
+def corpus_matrices(paths, workers=None):
+    files = corpus_files(paths)
+    with multiprocessing.Pool(workers) as pool:
+        tokenized = pool.map(tokenize_file, files)
+    files = [name for name, tokens in zip(files, tokenized) if tokens is not None]
+    tokenized = [tokens for tokens in tokenized if tokens is not None]
+
+    vocabulary = {}
+    for vec, _ in tokenized:
+        for key in vec:
+            vocabulary.setdefault(key, len(vocabulary))
+    counts = np.zeros((len(files), len(vocabulary)))
+    for row, (vec, _) in enumerate(tokenized):
+        counts[row, [vocabulary[key] for key in vec]] = list(vec.values())
+    norms = np.linalg.norm(counts, axis=1)
+    counts /= np.where(norms == 0, 1.0, norms)[:, None]
+    # Pages with no tags aren't similar to anything, as in cosine_similarity
+    cosine = np.clip(counts @ counts.T, 0.0, 1.0)
+
+    lengths = np.array([length for _, length in tokenized], dtype=float)
+    small = np.minimum.outer(lengths, lengths)
+    large = np.maximum.outer(lengths, lengths)
+    ratio = np.divide(small, large, out=np.zeros_like(small), where=large > 0)
+    return files, cosine, ratio
+
+# .npz files hold "files" plus one array per metric. CSV files get one row per
+# pair of files (each pair once), which clustering tools take as an edge list.
+def write_matrices(output, files, cosine, ratio):
+    if output.endswith('.csv'):
+        import csv
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('file1', 'file2') + CORPUS_METRICS)
+            for i, j in zip(*np.triu_indices(len(files), 1)):
+                writer.writerow((files[i], files[j], float(cosine[i, j]), float(ratio[i, j])))
+    else:
+        np.savez_compressed(output, files=np.array(files, dtype=str),
+                cosine_similarity=cosine, length_ratio=ratio)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare two pages, or with '
+            '--matrix, every pair of pages in a corpus')
+    parser.add_argument('files', nargs='+',
+            help='files (or URLs) to compare. With --matrix, directories are '
+            'searched for .html and .htm files')
+    parser.add_argument('--matrix', metavar='OUTPUT',
+            help='write the cosine similarity and length ratio of every pair '
+            'to OUTPUT, as .npz or .csv')
+    parser.add_argument('--workers', type=int,
+            help='processes to tokenize files with. Defaults to CPU count')
+    args = parser.parse_args()
+    if args.matrix is None and len(args.files) != 2:
+        parser.error('give exactly two files to compare, or use --matrix')
+    return args
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: % python <FILENAME1> <FILENAME2>", file=sys.stderr)
+    args = parse_args()
+    if args.matrix is None:
+        print(compare_files(args.files[0], args.files[1]))
     else:
-        print(compare_files(sys.argv[1], sys.argv[2]))
+        write_matrices(args.matrix, *corpus_matrices(args.files, args.workers))
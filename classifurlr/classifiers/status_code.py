@@ -1,22 +1,28 @@
 import logging
 
-from ..classification import Classifier, NotEnoughDataError
+import numpy as np
 
-class StatusCodeClassifier(Classifier):
+from ..classification import NotEnoughDataError
+from ..features import FeatureClassifier
+
+class StatusCodeClassifier(FeatureClassifier):
     def __init__(self):
-        Classifier.__init__(self)
+        FeatureClassifier.__init__(self)
         self.name = 'Status code'
         self.desc = 'A simple classifier that says all non-2xx status codes are down'
 
-    def page_down_confidence(self, page, session):
+    def down_confidences(self, features):
+        status = features.status
+        return np.where(np.isnan(status), np.nan,
+                ((status < 200) | (status > 299)).astype(float))
+
+    def missing_data_error(self, page, session):
         entry = page.actual_page
         if entry is None:
-            raise NotEnoughDataError('No final page found')
-        if 'response' not in entry or 'status' not in entry['response']:
-            raise NotEnoughDataError('"response" or "status" not found in entry '
-                    'for URL "{}"'.format(entry['rekwest']['url']))
-        status = page.actual_page['response']['status']
-        logging.debug("{} - Page: {} - Status: {}".format(self.slug(), page.page_id,
-            status))
-        return 1.0 if status < 200 or status > 299 else 0.0
+            return NotEnoughDataError('No final page found')
+        return NotEnoughDataError('"response" or "status" not found in entry '
+                'for URL "{}"'.format(entry['request']['url']))
 
+    def log_page(self, page, session, features, i):
+        logging.debug("{} - Page: {} - Status: {}".format(self.slug(), page.page_id,
+            int(features.status[i])))
@@ -1,30 +1,39 @@
 import logging
 
-from ..classification import Classifier
-from ..har_utils import get_total_size
+import numpy as np
 
-class ThrottleClassifier(Classifier):
+from ..classification import NotEnoughDataError
+from ..features import FeatureClassifier
+
+class ThrottleClassifier(FeatureClassifier):
     def __init__(self):
-        Classifier.__init__(self)
+        FeatureClassifier.__init__(self)
         self.name = 'Throttle'
         self.desc = 'Detects excessively long load times that might indicate throttling'
         self.total_confidence_above_size = 600
         self.time_threshold = 5 * 60 * 1000 # 5 minutes
         self.bandwidth_threshold = 50 # kbps
+        self.uses_timings = True
 
-    def page_down_confidence(self, page, session):
-        bites = get_total_size(page.entries)
-        kilobits = bites * 8 / 1000.0
-        mss = page.get_load_time()
-        seconds = mss / 1000.0
-        kilobits_per_sec = kilobits/seconds
-        logging.debug("{} - Page: {} - Bytes: {} - Time (ms): {} - kbps: {}".format(
-            self.slug(), page.page_id, bites, mss, round(kilobits_per_sec, 3)))
-        down = (mss >= self.time_threshold
-                and kilobits_per_sec <= self.bandwidth_threshold)
-        confidence = 0.0
-        if down:
-            # Simple linear intepolation between 0 and 100% confidence
-            confidence = min(1.0, bites / self.total_confidence_above_size)
-        return confidence
+    def kilobits_per_sec(self, bites, mss):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (bites * 8 / 1000.0) / (mss / 1000.0)
+
+    def down_confidences(self, features):
+        bites, mss = features.total_size, features.load_time
+        down = ((mss >= self.time_threshold)
+                & (self.kilobits_per_sec(bites, mss) <= self.bandwidth_threshold))
+        # Simple linear intepolation between 0 and 100% confidence
+        confidence = np.where(down,
+                np.minimum(1.0, bites / self.total_confidence_above_size), 0.0)
+        return np.where(np.isnan(bites) | np.isnan(mss), np.nan, confidence)
 
+    def missing_data_error(self, page, session):
+        return NotEnoughDataError('Could not determine size or load time of page '
+                '"{}"'.format(page.page_id))
+
+    def log_page(self, page, session, features, i):
+        bites, mss = features.total_size[i], features.load_time[i]
+        logging.debug("{} - Page: {} - Bytes: {} - Time (ms): {} - kbps: {}".format(
+            self.slug(), page.page_id, int(bites), int(mss),
+            round(float(self.kilobits_per_sec(bites, mss)), 3)))
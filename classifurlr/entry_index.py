@@ -0,0 +1,59 @@
+import collections
+from functools import cached_property
+
+from .classification import NotEnoughDataError
+from .har_utils import (har_entry_response_text, entry_content_kind, entry_to_key,
+        BINARY)
+from .url_utils import extract_domain
+
+# Everything the header and body checks need from an entry, pulled out once
+# per session. Bodies are decoded on demand through har_entry_response_text,
+# so every check reading the same entry shares one decoded copy, and binary
+# bodies (images, fonts, etc.) never are.
+class IndexedEntry:
+    def __init__(self, entry):
+        self.entry = entry
+        self.url = entry['request']['url']
+        self.headers = collections.defaultdict(list)
+        for header in entry['response'].get('headers', []):
+            self.headers[header['name'].lower()].append(header['value'])
+        self.locations = self.headers.get('location', [])
+        self.has_content = 'text' in entry['response'].get('content', {})
+        self.kind = entry_content_kind(entry) if self.has_content else None
+        self._body_error = None
+
+    @cached_property
+    def domain(self):
+        return extract_domain(self.url)
+
+    # Returns None for binary bodies, and raises NotEnoughDataError if the
+    # entry has no usable content. If limit is given, only about the first
+    # limit characters are decoded.
+    def body(self, limit=None):
+        if self.kind == BINARY: return None
+        if self._body_error is None:
+            try:
+                return har_entry_response_text(self.entry, limit)
+            except NotEnoughDataError as e:
+                self._body_error = e
+        raise self._body_error
+
+# A session's indexed entries, built as they're asked for.
+class EntryIndex:
+    def __init__(self, session=None):
+        self.entries = {}
+
+    @classmethod
+    def for_session(cls, session):
+        return session.get_derived('entry_index', cls)
+
+    def get(self, entry):
+        key = entry_to_key(entry)
+        if key not in self.entries:
+            self.entries[key] = IndexedEntry(entry)
+        return self.entries[key]
+
+    # Forgets entries nothing will look at again.
+    def release(self, entries):
+        for entry in entries:
+            self.entries.pop(entry_to_key(entry), None)
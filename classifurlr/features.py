@@ -0,0 +1,97 @@
+import logging
+
+import numpy as np
+
+from .classification import Classifier, NotEnoughDataError
+
+# The numbers about each page in a session that the simple threshold
+# classifiers look at, one column per feature and one row per page, so they
+# can be compared for every page at once. Values we couldn't get out of the
+# HAR are NaN.
+class PageFeatures:
+    COLUMNS = ('total_size', 'actual_size', 'status', 'load_time', 'entry_count',
+            'baseline_size')
+
+    def __init__(self, page_ids, columns):
+        self.page_ids = list(page_ids)
+        self.rows = {page_id: i for i, page_id in enumerate(self.page_ids)}
+        for name, column in zip(self.COLUMNS, columns):
+            setattr(self, name, np.asarray(column, dtype=float))
+
+    @classmethod
+    def from_pages(cls, pages, baseline=None):
+        page_ids, rows = [], []
+        for page in pages:
+            page_ids.append(page.page_id)
+            rows.append(cls.extract(page))
+        columns = np.full((len(cls.COLUMNS), len(rows)), np.nan)
+        if rows:
+            columns[:-1] = np.array(rows, dtype=float).T
+        # The baseline's size is repeated on every row so comparisons with it
+        # don't need to know which session a row came from.
+        if baseline is not None:
+            columns[-1] = cls.extract(baseline)[1]
+        return cls(page_ids, columns)
+
+    @classmethod
+    def for_session(cls, session):
+        return session.get_derived('page_features',
+                lambda s: cls.from_pages(s.iter_pages(), s.get_baseline()))
+
+    # Stacks the tables of several sessions. Page IDs needn't be unique across
+    # sessions, so row() isn't meaningful on the result.
+    @classmethod
+    def concatenate(cls, tables):
+        page_ids = [page_id for table in tables for page_id in table.page_ids]
+        columns = [np.concatenate([getattr(table, name) for table in tables])
+                if tables else np.empty(0) for name in cls.COLUMNS]
+        return cls(page_ids, columns)
+
+    @staticmethod
+    def extract(page):
+        values = []
+        for get in (lambda: page.total_size,
+                lambda: page.actual_page['response']['content']['size'],
+                lambda: page.actual_page['response']['status'],
+                lambda: page.get_load_time(),
+                lambda: len(page.entries)):
+            try:
+                values.append(get())
+            except (KeyError, TypeError, ValueError):
+                values.append(np.nan)
+        return values
+
+    def columns(self):
+        return [getattr(self, name) for name in self.COLUMNS]
+
+    def __len__(self):
+        return len(self.page_ids)
+
+    def row(self, page):
+        return self.rows[page.page_id]
+
+# A classifier that works out the down confidence of every page in a session
+# at once from its PageFeatures. Pages without the features it needs get NaN,
+# and missing_data_error says why. down_confidences only sees the table, so it
+# works just as well on many sessions' tables stacked together (see batch.py).
+class FeatureClassifier(Classifier):
+    def down_confidences(self, features):
+        raise NotImplementedError('FeatureClassifier must implement down_confidences')
+
+    def missing_data_error(self, page, session):
+        return NotEnoughDataError('Could not extract features for page '
+                '"{}"'.format(page.page_id))
+
+    def log_page(self, page, session, features, i):
+        pass
+
+    def page_down_confidence(self, page, session):
+        features = PageFeatures.for_session(session)
+        confidences = session.get_derived((self, 'down_confidences'),
+                lambda s: self.down_confidences(features))
+        i = features.row(page)
+        if np.isnan(confidences[i]):
+            raise self.missing_data_error(page, session)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            self.log_page(page, session, features, i)
+        return float(confidences[i])
@@ -1,7 +1,11 @@
 import logging, re
 
-from .har_utils import har_entry_response_content
+from .har_utils import DEFAULT_SCAN_WINDOW, scan_window_version
 from .classification import NotEnoughDataError
+from .entry_index import EntryIndex
+
+# Filters hold no per-session state (anything they work out about a session
+# is kept on the session), so one filter can serve many sessions at once.
 
 class Filter:
     def __init__(self):
@@ -13,25 +17,40 @@ class Filter:
         return self.name.lower().replace(' ', '_')
 
     def filter(self, session, pages):
-        self.session = session
+        tossed = self.filtered_out_ids(session, pages)
         keep, toss = [], []
         for page in pages:
-            if self.is_filtered_out(page):
+            if page.page_id in tossed:
                 toss.append(page)
             else:
                 keep.append(page)
         return (keep, toss)
 
-    def is_filtered_out(self, page):
+    # The IDs of the pages to filter out. Filters that can do better by
+    # looking at all the pages at once override this.
+    def filtered_out_ids(self, session, pages):
+        return set(page.page_id for page in pages if self.is_filtered_out(page, session))
+
+    def is_filtered_out(self, page, session):
         raise NotImplementedError('must implement #is_filtered_out')
 
 class InconclusiveFilter(Filter):
-    def __init__(self):
+    def __init__(self, scan_window=DEFAULT_SCAN_WINDOW):
         Filter.__init__(self)
         self.name = 'Inconclusive'
         self.desc = 'Filters out pages that look inconclusive (CDN captchas, VPN timeouts, etc.)'
+        # The seizure banner is at the top of the page.
+        self.scan_window = scan_window
+
+    @property
+    def version(self):
+        return scan_window_version(self.code_version, self.scan_window)
+
+    @version.setter
+    def version(self, value):
+        self.code_version = value
 
-    def is_captcha_challenge(self, page):
+    def is_captcha_challenge(self, page, session, index):
         entry = page.actual_page
         if entry is None:
             return False
@@ -41,41 +60,40 @@ class InconclusiveFilter(Filter):
         status = page.actual_page['response']['status']
         if status != 403:
             return False
-        for header in entry['response']['headers']:
-            # Incapsula CDN
-            if (header['name'].lower() == 'set-cookie' and
-                header['value'].lower().startswith('incap_ses_')):
-                return True
+        headers = index.get(entry).headers
+        # Incapsula CDN
+        if any(value.lower().startswith('incap_ses_') for value in headers['set-cookie']):
+            return True
+        # Cloudflare and Akamai CDNs
+        return any(value in ('cloudflare-nginx', 'AkamaiGHost') for value in headers['server'])
 
-            # Cloudflare and Akamai CDNs
-            if (header['name'].lower() == 'server' and
-                    (header['value'] == 'cloudflare-nginx' or
-                     header['value'] == 'AkamaiGHost')):
-                        return True
+    def is_isp_login(self, page, session, index):
         return False
 
-    def is_isp_login(self, page):
-        pass
+    SEIZED_BODY_PATTERNS = [
+            re.compile(re.escape('This domain name has been seized by ICE - Homeland Security Investigations')),# US
+            ]
 
-    def is_seized_domain(self, page):
-        body_patterns = [
-                re.escape('This domain name has been seized by ICE - Homeland Security Investigations'),# US
-                ]
+    def is_seized_domain(self, page, session, index):
+        if page.actual_page is None:
+            return False
         try:
-            body = har_entry_response_content(page.actual_page)
+            body = index.get(page.actual_page).body(self.scan_window)
         except NotEnoughDataError:
             return False
-        for pattern in body_patterns:
-            match = re.search(pattern, body)
+        if body is None:
+            return False
+        for pattern in self.SEIZED_BODY_PATTERNS:
+            match = pattern.search(body)
             if match is not None:
                 logging.debug('{} - Page: {} - Body Pattern: "{}" '
                         '- Matched: "{}"'.format(self.slug(), page.page_id,
-                            pattern, match.group(0)))
+                            pattern.pattern, match.group(0)))
                 return True
         return False
 
-    def is_vpn_timeout(self, page):
-        errors = self.session.get_page_errors(page.page_id)
+    def is_vpn_timeout(self, page, session, index):
+        errors = session.get_page_errors(page.page_id)
         if errors is None or len(errors) == 0:
             return False
         return any([
@@ -85,13 +103,24 @@ class InconclusiveFilter(Filter):
                 e.startswith("(7, 'Failed to connect") for e in errors if
                 e is not None])
 
-    def is_filtered_out(self, page):
-        return (
-                self.is_captcha_challenge(page) or
-                self.is_vpn_timeout(page) or
-                self.is_isp_login(page) or
-                self.is_seized_domain(page)
-                )
+    # Cheapest first. Each check runs over every page still in the running
+    # before the next starts, so bodies are only decoded for pages nothing
+    # cheaper filtered out.
+    def checks(self):
+        return (self.is_vpn_timeout, self.is_captcha_challenge,
+                self.is_isp_login, self.is_seized_domain)
+
+    def filtered_out_ids(self, session, pages):
+        index = EntryIndex.for_session(session)
+        tossed = set()
+        for check in self.checks():
+            for page in pages:
+                if page.page_id not in tossed and check(page, session, index):
+                    tossed.add(page.page_id)
+        return tossed
+
+    def is_filtered_out(self, page, session):
+        return len(self.filtered_out_ids(session, [page])) > 0
 
 class RelevanceFilter(Filter):
     def __init__(self):
@@ -99,16 +128,16 @@ class RelevanceFilter(Filter):
         self.name = 'Relevance'
         self.desc = 'Filters out pages that are not relevant to the given URL'
 
-    def is_filtered_out(self, page):
+    def is_filtered_out(self, page, session):
         # Don't consider the baseline when classifying
-        if self.session.get_baseline_id() == page.page_id:
+        if session.get_baseline_id() == page.page_id:
             logging.debug("Filtering out baseline {}".format(page.page_id))
             return True
 
         # page.url is the initial requested url
-        if not page.url.startswith(self.session.url):
+        if not page.url.startswith(session.url):
             logging.info('Possibly irrelevant page when looking for '
-                    '"{}": {}'.format(self.session.url, page.url))
+                    '"{}": {}'.format(session.url, page.url))
             #return True
         return False
 
@@ -0,0 +1,112 @@
+from functools import cached_property
+
+from .time_utils import timestamp_micros
+
+def is_redirect(entry):
+    return 300 <= entry['response']['status'] <= 399
+
+# A page from a HAR file. Stands in for haralyzer's HarPage, exposing the
+# parts of it the classifiers use, but with entries left as plain dicts and
+# everything derived from them computed at most once.
+class HarPage:
+    def __init__(self, page, entries):
+        self.page_id = page['id']
+        self.title = page.get('title', '')
+        self.startedDateTime = page['startedDateTime']
+        self.pageTimings = page.get('pageTimings', {})
+        self.entries = entries
+
+    def __repr__(self):
+        return 'ID: {}, URL: {}'.format(self.page_id, self.url)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    # The initial requested url
+    @cached_property
+    def url(self):
+        return self.entries[0]['request'].get('url')
+
+    # The first response that isn't a redirect, i.e. the page we landed on.
+    @cached_property
+    def actual_page(self):
+        for entry in self.entries:
+            if not is_redirect(entry):
+                return entry
+        return None
+
+    # The redirects we followed to get to actual_page.
+    @cached_property
+    def redirect_chain(self):
+        chain = []
+        for entry in self.entries:
+            if not is_redirect(entry): break
+            chain.append(entry)
+        return chain
+
+    @cached_property
+    def total_size(self):
+        return sum(entry['response']['content']['size'] for entry in self.entries
+                if entry['response']['content']['size'] > 0)
+
+    # Milliseconds during which at least one entry was loading, so parallel
+    # requests aren't counted twice. Same as haralyzer's get_load_time(), which
+    # counts the distinct milliseconds (offset from each entry's start time) in
+    # a timeline - done here by merging intervals instead of building one.
+    @cached_property
+    def load_time(self):
+        # Entries whose start times differ by a whole number of milliseconds
+        # land on the same millisecond ticks and can overlap; others can't.
+        by_offset = {}
+        for entry in self.entries:
+            start = timestamp_micros(entry['startedDateTime'])
+            ticks, offset = divmod(start, 1000)
+            by_offset.setdefault(offset, []).append(
+                    (ticks, ticks + max(int(entry['time']), 1)))
+        total = 0
+        for intervals in by_offset.values():
+            intervals.sort()
+            start, end = intervals[0]
+            for s, e in intervals[1:]:
+                if s > end:
+                    total += end - start
+                    start, end = s, e
+                else:
+                    end = max(end, e)
+            total += end - start
+        return total
+
+    def get_load_time(self):
+        return self.load_time
+
+# Groups a HAR's entries by page in one pass over them, rather than one pass
+# per page. Like haralyzer, entries are ordered by start time and entries
+# referring to a page that isn't in the HAR are dropped.
+def group_entries(har):
+    log = har['log']
+    entries = {page['id']: [] for page in log.get('pages', [])}
+    for entry in log['entries']:
+        if 'pageref' not in entry:
+            raise ValueError('HAR entry for "{}" has no pageref'.format(
+                entry['request'].get('url')))
+        if entry['pageref'] in entries:
+            entries[entry['pageref']].append(entry)
+    for page_entries in entries.values():
+        page_entries.sort(key=lambda entry: timestamp_micros(entry['startedDateTime']))
+    return entries
+
+# Builds a HAR's pages one at a time, so callers that only need one page at
+# a time never hold them all. If page_ids is given, only those pages are
+# built, in that order.
+def iter_pages(har, entries=None, page_ids=None):
+    if entries is None:
+        entries = group_entries(har)
+    pages = har['log'].get('pages', [])
+    if page_ids is not None:
+        by_id = {page['id']: page for page in pages}
+        pages = (by_id[page_id] for page_id in page_ids)
+    for page in pages:
+        yield HarPage(page, entries[page['id']])
+
+def load_pages(har):
+    return list(iter_pages(har))
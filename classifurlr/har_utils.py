@@ -1,4 +1,4 @@
-import base64
+import base64, codecs, re, threading
 
 from bs4 import BeautifulSoup
 from cachetools import cached, LRUCache
@@ -9,14 +9,140 @@ def entry_to_key(entry):
     if entry:
         return (entry['request']['url'], entry['startedDateTime'], entry['pageref'])
 
-@cached(cache=LRUCache(maxsize=32), key=entry_to_key)
-def har_entry_response_content(entry):
+# What kind of body an entry has, which decides how (and whether) we decode it.
+# HTML - markup (or anything we can't tell isn't), normalized with BeautifulSoup
+# TEXT - scripts, stylesheets, JSON and the like, just decoded
+# BINARY - images, fonts, media, archives - never decoded
+HTML, TEXT, BINARY = 'html', 'text', 'binary'
+
+BINARY_MIME_PREFIXES = ('image/', 'font/', 'video/', 'audio/',
+        'application/font', 'application/x-font', 'application/vnd.ms-fontobject',
+        'application/octet-stream', 'application/pdf', 'application/zip',
+        'application/x-shockwave-flash', 'application/ogg', 'application/wasm')
+TEXT_MIME_TYPES = ('text/css', 'text/javascript', 'application/javascript',
+        'application/x-javascript', 'application/ecmascript', 'application/json',
+        'text/json')
+# Leading bytes of common binary formats
+MAGIC_BYTES = (b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'RIFF', b'wOFF', b'wOF2',
+        b'\x00\x01\x00\x00', b'OTTO', b'\x00\x00\x01\x00', b'%PDF', b'PK\x03\x04',
+        b'\x1f\x8b', b'OggS', b'ID3', b'\x1aE\xdf\xa3', b'FWS', b'CWS', b'\x00asm')
+
+# Set on content whose binary body was dropped when loading (see loading.py)
+OMITTED_BODY = '_omitted'
+
+def entry_content_kind(entry):
+    content = entry['response']['content']
+    if content.get(OMITTED_BODY) or is_binary_content(content):
+        return BINARY
+    if content_mime_type(content) in TEXT_MIME_TYPES:
+        return TEXT
+    return HTML
+
+def content_mime_type(content):
+    return content.get('mimeType', '').split(';')[0].strip().lower()
+
+def is_binary_content(content):
+    mime_type = content_mime_type(content)
+    if mime_type.startswith(BINARY_MIME_PREFIXES) and mime_type != 'image/svg+xml':
+        return True
+    return is_binary_body(content)
+
+# Only decodes enough of the body to check for magic bytes.
+def is_binary_body(content):
+    text = content.get('text')
+    if not text: return False
+    if content.get('encoding') == 'base64':
+        try:
+            head = base64.b64decode(text[:24])
+        except ValueError:
+            return False
+    else:
+        head = text[:16].encode('latin-1', 'ignore')
+    return head.startswith(MAGIC_BYTES) or head[4:8] == b'ftyp' # MP4/MOV
+
+def entry_content(entry):
     try:
         content = entry['response']['content']
     except Exception:
         raise NotEnoughDataError('Could not parse entry content')
     if 'text' not in content:
         raise NotEnoughDataError('"text" field not found in entry content')
+    if entry_content_kind(entry) == BINARY:
+        raise NotEnoughDataError('Entry content is binary')
+    return content
+
+# How much decoded text (in characters) pattern matching looks at by default.
+# None means whole bodies. Block pages and the banners we look for come early
+# in the document, so callers with multi-megabyte pages can pass a window
+# (like 64 * 1024) to bound the cost of decoding and scanning each one.
+DEFAULT_SCAN_WINDOW = None
+BASE64_CHUNK = 16 * 1024 # must be a multiple of 4
+
+# Results depend on how much of each body was scanned, so a scan window other
+# than the default is part of the version of whatever did the scanning.
+def scan_window_version(version, scan_window):
+    if scan_window == DEFAULT_SCAN_WINDOW: return version
+    return '{}+scan-{}'.format(version, 'all' if scan_window is None else scan_window)
+
+def text_key(entry, limit=None):
+    return (entry_to_key(entry), limit)
+
+# Decoded bodies, shared by everything that looks at the same entry. Sessions
+# are classified on several threads at once (see filters.py), so the caches
+# are only touched with CACHE_LOCK held.
+TEXT_CACHE = LRUCache(maxsize=32)
+CONTENT_CACHE = LRUCache(maxsize=32)
+CACHE_LOCK = threading.Lock()
+
+# The entry's body as a string, decoded but otherwise untouched. This is what
+# pattern matching should use - it's much cheaper than parsing. If limit is
+# given, only (about) the first limit characters are decoded and returned.
+@cached(cache=TEXT_CACHE, key=text_key, lock=CACHE_LOCK)
+def har_entry_response_text(entry, limit=None):
+    content = entry_content(entry)
+    text = content['text']
+    if 'encoding' in content and content['encoding'] == 'base64':
+        if limit is not None:
+            try:
+                return decode_base64_prefix(entry, text, limit)
+            except ValueError:
+                pass # Odd padding or whitespace - just decode the lot
+        body = base64.b64decode(text)
+        text = decode_body(body, body_charset(entry, body))
+    if limit is not None:
+        return text[:limit]
+    return text
+
+# Decodes base64 and then text a chunk at a time, stopping once we have
+# enough characters.
+def decode_base64_prefix(entry, text, limit):
+    head = base64.b64decode(text[:BASE64_CHUNK])
+    charset = body_charset(entry, head)
+    if charset is None:
+        try:
+            return decode_prefix(head, text, 'utf-8', 'strict', limit)
+        except UnicodeDecodeError:
+            charset = 'cp1252'
+    return decode_prefix(head, text, charset, 'replace', limit)
+
+def decode_prefix(head, text, charset, errors, limit):
+    decoder = codecs.getincrementaldecoder(charset)(errors)
+    decoded = [decoder.decode(head)]
+    length = len(decoded[0])
+    for start in range(BASE64_CHUNK, len(text), BASE64_CHUNK):
+        if length >= limit: break
+        piece = decoder.decode(base64.b64decode(text[start:start + BASE64_CHUNK]))
+        decoded.append(piece)
+        length += len(piece)
+    return ''.join(decoded)[:limit]
+
+# The entry's body normalized by BeautifulSoup, for things that care about
+# document structure.
+@cached(cache=CONTENT_CACHE, key=entry_to_key, lock=CACHE_LOCK)
+def har_entry_response_content(entry):
+    content = entry_content(entry)
+    if entry_content_kind(entry) == TEXT:
+        return har_entry_response_text(entry)
     text = content['text']
     if 'encoding' in content and content['encoding'] == 'base64':
         text = base64.b64decode(text)
@@ -26,6 +152,58 @@ def har_entry_response_content(entry):
     except Exception as e:
         raise NotEnoughDataError('Could not parse entry content')
 
+# Drops any decoded bodies we're holding for these entries, for when we know
+# nothing will look at them again.
+def release_entry_content(entries):
+    keys = set(entry_to_key(entry) for entry in entries)
+    with CACHE_LOCK:
+        for key in [k for k in TEXT_CACHE if k[0] in keys]:
+            TEXT_CACHE.pop(key, None)
+        for key in [k for k in CONTENT_CACHE if k in keys]:
+            CONTENT_CACHE.pop(key, None)
+
+BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16'))
+META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.I)
+
+# Where the charset comes from, in order of precedence: a byte order mark,
+# the Content-Type header, the HAR's mimeType, then a <meta> in the first KB.
+def body_charset(entry, body):
+    for bom, charset in BOMS:
+        if body.startswith(bom): return charset
+    declared = [header['value'] for header in entry['response'].get('headers', [])
+            if header['name'].lower() == 'content-type']
+    declared.append(entry['response']['content'].get('mimeType', ''))
+    for mime_type in declared:
+        charset = mime_charset(mime_type)
+        if charset is not None: return charset
+    match = META_CHARSET.search(body[:1024])
+    if match is not None:
+        return known_charset(match.group(1).decode('ascii', 'ignore'))
+    return None
+
+# Falls back to UTF-8 and then Windows-1252 like browsers do.
+def decode_body(body, charset=None):
+    if charset is not None:
+        return body.decode(charset, 'replace')
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        return body.decode('cp1252', 'replace')
+
+def mime_charset(mime_type):
+    for param in mime_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            return known_charset(value.strip().strip('"\''))
+    return None
+
+def known_charset(charset):
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return None
+
 # Using the size property of the content instead of the bodySize
 # as the latter gets wrong values sometimes for some websites.
 # See https://bugs.chromium.org/p/chromium/issues/detail?id=379130
@@ -0,0 +1,34 @@
+import json
+
+from .har_utils import is_binary_content, OMITTED_BODY
+
+# Loads session JSON while dropping the heavy fields that no classifier reads:
+# pageDetail screenshots and the bodies of binary responses (images, fonts,
+# video, etc.). They're dropped as each object is parsed, so they're never
+# all held at once. Binary bodies are replaced with an empty string and
+# marked, so entries still look like they had content.
+class SessionDecoder(json.JSONDecoder):
+    def __init__(self, keep_screenshots=False, keep_binary_bodies=False, **kwargs):
+        self.keep_screenshots = keep_screenshots
+        self.keep_binary_bodies = keep_binary_bodies
+        super().__init__(object_hook=self.project, **kwargs)
+
+    def project(self, obj):
+        if not self.keep_screenshots and 'screenshot' in obj:
+            del obj['screenshot']
+        # HAR response content objects - postData has mimeType and text too,
+        # but no size.
+        if (not self.keep_binary_bodies and 'mimeType' in obj and 'size' in obj
+                and obj.get('text') and is_binary_content(obj)):
+            obj['text'] = ''
+            obj.pop('encoding', None)
+            obj[OMITTED_BODY] = True
+        return obj
+
+def loads_session(data, **kwargs):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return SessionDecoder(**kwargs).decode(data)
+
+def load_session(fp, **kwargs):
+    return loads_session(fp.read(), **kwargs)
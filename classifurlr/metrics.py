@@ -0,0 +1,187 @@
+import bisect, threading
+
+# Just enough of Prometheus' client to count and time what the pipeline does
+# and expose it in the text exposition format, without the dependency.
+# Recording is a dict update under a lock, so it's cheap enough to leave on.
+# Metrics are per process, so under a pre-fork server each worker reports its
+# own.
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    if len(names) == 0: return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label(value))
+            for name, value in zip(names, values)) + '}'
+
+def format_value(value):
+    if value == float('inf'): return '+Inf'
+    return repr(value)
+
+def sample_order(item):
+    return tuple(str(value) for value in item[0])
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    # (name suffix, extra labels, label values, value) for each sample
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items(), key=sample_order)
+        return [('', (), key, value) for key, value in items]
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help.replace('\n', ' ')),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, extra, values, value in self.samples():
+            names = self.labels + tuple(name for name, _ in extra)
+            values = tuple(values) + tuple(v for _, v in extra)
+            lines.append('{}{}{} {}'.format(self.name, suffix,
+                format_labels(names, values), format_value(value)))
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+# A metric whose value is read when it's scraped, for things that keep their
+# own counts (like the result cache).
+class CallbackMetric(Metric):
+    def __init__(self, name, help, kind, read):
+        Metric.__init__(self, name, help)
+        self.kind = kind
+        self.read = read
+
+    def samples(self):
+        return [('', (), (), self.read())]
+
+# Seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0, 30.0)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    # Keeps a count per bucket (not cumulative), plus the sum.
+    def observe(self, value, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = self.values[label_values]
+            counts[0][i] += 1
+            counts[1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = sorted(((key, (list(counts), total))
+                for key, (counts, total) in self.values.items()), key=sample_order)
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', (('le', format_value(float(bound))),),
+                    key, cumulative))
+            samples.append(('_sum', (), key, total))
+            samples.append(('_count', (), key, cumulative))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, kind, read):
+        return self.register(CallbackMetric(name, help, kind, read))
+
+    def exposition(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.exposition()
+        return '\n'.join(lines) + '\n'
+
+# What a ClassifyPipeline records when given one of these.
+class PipelineMetrics:
+    def __init__(self, registry=None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.sessions = r.counter('classifurlr_sessions_total',
+                'Sessions classified, by verdict', ('status',))
+        self.session_seconds = r.histogram('classifurlr_session_duration_seconds',
+                'Time to classify a session')
+        self.pages = r.counter('classifurlr_pages_total',
+                'Pages classified, by verdict', ('status',))
+        self.filtered = r.counter('classifurlr_filtered_pages_total',
+                'Pages filtered out, by filter', ('filter',))
+        self.filter_seconds = r.histogram('classifurlr_filter_duration_seconds',
+                'Time spent in each filter per call', ('filter',))
+        self.verdicts = r.counter('classifurlr_classifier_verdicts_total',
+                'Page classifications, by classifier, verdict and whether the '
+                'result was reused from an identical page',
+                ('classifier', 'status', 'reused'))
+        self.classifier_seconds = r.histogram('classifurlr_classifier_duration_seconds',
+                'Time for a classifier to classify a page (not counting reused '
+                'results)', ('classifier',))
+
+    def observe_session(self, classification, seconds):
+        self.sessions.inc(classification.direction)
+        self.session_seconds.observe(seconds)
+
+    def observe_pages(self, page_classifications):
+        for c in page_classifications:
+            self.pages.inc(c.direction)
+
+    def observe_filter(self, filt, toss, seconds):
+        if len(toss) > 0:
+            self.filtered.inc(filt.slug(), amount=len(toss))
+        self.filter_seconds.observe(seconds, filt.slug())
+
+    def observe_classifier(self, classification, seconds):
+        slug = classification.classifier.slug()
+        self.verdicts.inc(slug, classification.direction, 'false')
+        self.classifier_seconds.observe(seconds, slug)
+
+    def observe_reused(self, classification):
+        self.verdicts.inc(classification.classifier.slug(), classification.direction, 'true')
+
+    # Reports a ResultCache's lookups as they stand when scraped.
+    def track_cache(self, cache):
+        self.registry.callback('classifurlr_cache_hits_total',
+                'Result cache hits', 'counter', lambda: cache.hits)
+        self.registry.callback('classifurlr_cache_misses_total',
+                'Result cache misses', 'counter', lambda: cache.misses)
+        self.registry.callback('classifurlr_cache_hit_ratio',
+                'Share of result cache lookups that were hits', 'gauge', cache.hit_ratio)
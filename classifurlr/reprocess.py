@@ -0,0 +1,201 @@
+import argparse, json, logging, multiprocessing, os, queue, sys, time
+
+import classifurlr
+from . import serialization
+
+# Reclassifies a directory of stored sessions, split into shards that are
+# each handled by their own worker process. Each shard appends one line per
+# session to its own results file and regularly checkpoints how many of its
+# sessions are done and how long its results file was at the time. A rerun
+# against the same output directory truncates every results file back to its
+# last checkpoint and carries on from there, so each session's result is
+# written exactly once however many times the run is interrupted. A shard
+# whose results file is missing or shorter than its checkpoint starts over.
+#
+# Output directory layout:
+#   manifest.json - the input files, the number of shards and the options
+#   results-NNNN.jsonl - {"file": ..., "result": ...} or {"file": ..., "error": ...}
+#   checkpoint-NNNN.json - {"done": ..., "offset": ..., "pages": ...}
+
+MANIFEST = 'manifest.json'
+
+def results_path(output_dir, shard):
+    return os.path.join(output_dir, 'results-{:04d}.jsonl'.format(shard))
+
+def checkpoint_path(output_dir, shard):
+    return os.path.join(output_dir, 'checkpoint-{:04d}.json'.format(shard))
+
+# Writes JSON so that a crash leaves either the old file or the new one.
+def write_json_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_checkpoint(output_dir, shard):
+    try:
+        with open(checkpoint_path(output_dir, shard)) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return {'done': 0, 'offset': 0, 'pages': 0}
+    try:
+        size = os.path.getsize(results_path(output_dir, shard))
+    except FileNotFoundError:
+        size = None
+    if size is None or size < checkpoint['offset']:
+        # Truncating to the checkpoint would pad the file with NULs.
+        logging.warning('Results for shard {} are {} (checkpoint is at byte {}); '
+                'starting the shard over'.format(shard,
+                    'missing' if size is None else '{} bytes'.format(size),
+                    checkpoint['offset']))
+        return {'done': 0, 'offset': 0, 'pages': 0}
+    return checkpoint
+
+def list_sessions(input_dir):
+    files = []
+    for root, _, names in os.walk(input_dir):
+        for name in names:
+            if name.endswith('.json'):
+                files.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(files)
+
+# Starts a new run, or picks up the manifest of an interrupted one. The file
+# list and shard count are fixed by the first run so shards never change
+# under a resume.
+def load_manifest(input_dir, output_dir, shards, options):
+    path = os.path.join(output_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest['options'] != options:
+            raise ValueError('{} was made with options {}, not {}'.format(
+                path, manifest['options'], options))
+        logging.info('Resuming run of {} sessions in {} shards'.format(
+            len(manifest['files']), manifest['shards']))
+        return manifest
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = {'input_dir': os.path.abspath(input_dir),
+            'files': list_sessions(input_dir), 'shards': shards,
+            'options': options}
+    write_json_atomic(path, manifest)
+    return manifest
+
+def shard_files(manifest, shard):
+    return manifest['files'][shard::manifest['shards']]
+
+def classify_file(path, options):
+    with open(path, 'r', encoding='utf-8') as f:
+        session = classifurlr.load_session(f)
+    pages = len(session.get('har', {}).get('log', {}).get('pages', []))
+    c = classifurlr.run(session, prune_stale_pages=options['prune_stale_pages'],
+            scan_window=options['scan_window'])
+    return serialization.dumps(c), pages
+
+def run_shard(manifest, output_dir, shard, checkpoint_every, progress):
+    options = manifest['options']
+    checkpoint = read_checkpoint(output_dir, shard)
+    files = shard_files(manifest, shard)
+    mode = 'r+b' if os.path.exists(results_path(output_dir, shard)) else 'wb'
+    with open(results_path(output_dir, shard), mode) as out:
+        # Anything past the checkpoint is from sessions we'll redo.
+        out.truncate(checkpoint['offset'])
+        out.seek(checkpoint['offset'])
+        since_checkpoint = 0
+        for i in range(checkpoint['done'], len(files)):
+            name = files[i]
+            try:
+                result, pages = classify_file(
+                        os.path.join(manifest['input_dir'], name), options)
+                line = '{{"file":{},"result":{}}}\n'.format(json.dumps(name), result)
+            except Exception as e:
+                logging.warning('Could not classify {}: {}'.format(name, e))
+                result, pages = None, 0
+                line = json.dumps({'file': name, 'error': str(e)}) + '\n'
+            out.write(line.encode('utf-8'))
+            checkpoint['done'] = i + 1
+            checkpoint['pages'] += pages
+            progress.put((shard, 1, pages))
+            since_checkpoint += 1
+            if since_checkpoint >= checkpoint_every or i + 1 == len(files):
+                out.flush()
+                os.fsync(out.fileno())
+                checkpoint['offset'] = out.tell()
+                write_json_atomic(checkpoint_path(output_dir, shard), checkpoint)
+                since_checkpoint = 0
+
+def report(done, total, pages, started, out=sys.stderr):
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print('{}/{} sessions - {:.2f} sessions/s - {:.1f} pages/s'.format(
+        done['sessions'], total, done['run_sessions'] / elapsed,
+        pages / elapsed), file=out, flush=True)
+
+# Returns the number of sessions and pages classified in this run.
+def reprocess(input_dir, output_dir, workers=None, prune_stale_pages=False,
+        scan_window=classifurlr.DEFAULT_SCAN_WINDOW, checkpoint_every=10,
+        report_every=10.0, out=sys.stderr):
+    options = {'prune_stale_pages': prune_stale_pages, 'scan_window': scan_window}
+    manifest = load_manifest(input_dir, output_dir,
+            workers or os.cpu_count() or 1, options)
+    shards = manifest['shards']
+    already = sum(read_checkpoint(output_dir, s)['done'] for s in range(shards))
+    done = {'sessions': already, 'run_sessions': 0}
+    pages = 0
+
+    progress = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_shard,
+        args=(manifest, output_dir, shard, checkpoint_every, progress))
+        for shard in range(shards)
+        if read_checkpoint(output_dir, shard)['done'] < len(shard_files(manifest, shard))]
+    started = last_report = time.monotonic()
+    for process in processes:
+        process.start()
+    while any(p.is_alive() for p in processes) or not progress.empty():
+        try:
+            _, sessions, page_count = progress.get(timeout=0.5)
+            done['sessions'] += sessions
+            done['run_sessions'] += sessions
+            pages += page_count
+        except queue.Empty:
+            pass
+        if time.monotonic() - last_report >= report_every:
+            report(done, len(manifest['files']), pages, started, out)
+            last_report = time.monotonic()
+    for process in processes:
+        process.join()
+    report(done, len(manifest['files']), pages, started, out)
+    failed = [p.exitcode for p in processes if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('{} shard workers failed; rerun to resume'.format(len(failed)))
+    return done['run_sessions'], pages
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Reclassify a directory of '
+            'stored sessions, resuming where any earlier run left off')
+    parser.add_argument('input_dir', help='directory of session JSON files')
+    parser.add_argument('output_dir', help='directory for results and checkpoints')
+    parser.add_argument('--workers', type=int,
+            help='worker processes (and shards) for a new run. Defaults to CPU count')
+    parser.add_argument('--prune', action='store_true',
+            help='Skip pages too old to affect the verdict')
+    parser.add_argument('--scan-window', metavar='KB', type=int, default=0,
+            help='only search this much of each response body for block page '
+            'text, in KB, to bound the time spent on huge pages. 0 (the '
+            'default) searches whole bodies')
+    parser.add_argument('--checkpoint-every', metavar='N', type=int, default=10,
+            help='sessions between checkpoints')
+    parser.add_argument('--report-every', metavar='SECONDS', type=float, default=10.0,
+            help='how often to print throughput')
+    parser.add_argument('--debug', action='store_true',
+            help='Log debugging info')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+    reprocess(args.input_dir, args.output_dir, workers=args.workers,
+            prune_stale_pages=args.prune,
+            scan_window=args.scan_window * 1024 or None,
+            checkpoint_every=args.checkpoint_every,
+            report_every=args.report_every)
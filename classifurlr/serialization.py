@@ -0,0 +1,87 @@
+import json, math
+from json.encoder import encode_basestring_ascii
+
+# Roughly one TCP window - small enough to keep memory flat, big enough that
+# we're not making a syscall per field.
+WRITE_BUFFER_SIZE = 64 * 1024
+
+def encode_scalar(value):
+    if value is None: return 'null'
+    if value is True: return 'true'
+    if value is False: return 'false'
+    if isinstance(value, str): return encode_basestring_ascii(value)
+    if isinstance(value, float):
+        # json.dumps writes NaN and Infinity, which float's repr doesn't
+        if math.isfinite(value): return float.__repr__(value)
+        return json.dumps(value)
+    if isinstance(value, int): return int.__repr__(value)
+    return json.dumps(value)
+
+# Containers (like Classification.details) are rare, so they just go through
+# json.dumps, indented to match their position.
+def encode_value(value, pretty, level):
+    if not isinstance(value, (dict, list, tuple)):
+        return encode_scalar(value)
+    if not pretty:
+        return json.dumps(value, separators=(',', ':'))
+    return json.dumps(value, indent=2).replace('\n', '\n' + '  ' * level)
+
+# Walks a classification tree and yields JSON text in pieces, without ever
+# building the intermediate dict or the full string. The output is identical
+# to json.dumps(c.as_dict()) with the equivalent indent/separators.
+def iterencode(classification, pretty=False, _level=0):
+    if pretty:
+        item_sep = ',\n' + '  ' * (_level + 1)
+        key_sep = ': '
+        opening = '{\n' + '  ' * (_level + 1)
+        closing = '\n' + '  ' * _level + '}'
+    else:
+        item_sep, key_sep, opening, closing = ',', ':', '{', '}'
+
+    yield opening
+    yield item_sep.join(encode_basestring_ascii(k) + key_sep + encode_value(v, pretty, _level + 1)
+            for k, v in classification.as_fields())
+    constituents = classification.get_constituents()
+    if constituents is not None:
+        yield item_sep + '"constituents"' + key_sep
+        if len(constituents) == 0:
+            yield '[]'
+        else:
+            if pretty:
+                list_opening = '[\n' + '  ' * (_level + 2)
+                list_sep = ',\n' + '  ' * (_level + 2)
+                list_closing = '\n' + '  ' * (_level + 1) + ']'
+            else:
+                list_opening, list_sep, list_closing = '[', ',', ']'
+            yield list_opening
+            for i, constituent in enumerate(constituents):
+                if i > 0: yield list_sep
+                yield from iterencode(constituent, pretty, _level + 2)
+            yield list_closing
+    yield closing
+
+def dumps(classification, pretty=False):
+    return ''.join(iterencode(classification, pretty))
+
+# Streams a classification to anything with a write() method - a file,
+# sys.stdout, or a socket wrapped with socket.makefile(). If encoding is given,
+# bytes are written instead of str (for binary files and raw sockets).
+def dump(classification, fp, pretty=False, encoding=None):
+    for text in _buffered(classification, pretty):
+        fp.write(text if encoding is None else text.encode(encoding))
+
+# Same as dump, but yields encoded chunks. Useful as a WSGI response body.
+def iter_chunks(classification, pretty=False, encoding='utf-8'):
+    for text in _buffered(classification, pretty):
+        yield text.encode(encoding)
+
+def _buffered(classification, pretty):
+    buf, buffered = [], 0
+    for chunk in iterencode(classification, pretty):
+        buf.append(chunk)
+        buffered += len(chunk)
+        if buffered >= WRITE_BUFFER_SIZE:
+            yield ''.join(buf)
+            buf, buffered = [], 0
+    if buf:
+        yield ''.join(buf)
@@ -0,0 +1,24 @@
+import datetime
+
+import dateutil.parser
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+# HAR timestamps are ISO 8601, so the stdlib parser handles nearly all of them
+# much faster than dateutil. Naive timestamps are read as local time.
+def parse_datetime(value):
+    try:
+        when = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        when = dateutil.parser.parse(value)
+    if when.tzinfo is None:
+        when = when.astimezone()
+    return when
+
+# Seconds since the epoch.
+def parse_timestamp(value):
+    return parse_datetime(value).timestamp()
+
+# Microseconds since the epoch, exact (unlike a float timestamp).
+def timestamp_micros(value):
+    return (parse_datetime(value) - EPOCH) // datetime.timedelta(microseconds=1)
@@ -1,25 +1,114 @@
 import classifurlr, classifurlr.theme_status
-import json
+from classifurlr import serialization
+import json, math, os, time
+from urllib.parse import parse_qs
+
+# Set CLASSIFURLR_CACHE to the path of a SQLite file to cache results.
+CACHE = None
+if os.environ.get('CLASSIFURLR_CACHE'):
+    CACHE = classifurlr.ResultCache(os.environ['CLASSIFURLR_CACHE'])
+
+# Served in Prometheus' text format at /metrics. Each worker process keeps
+# its own.
+METRICS = classifurlr.PipelineMetrics()
+if CACHE is not None:
+    METRICS.track_cache(CACHE)
+REQUESTS = METRICS.registry.counter('classifurlr_requests_total',
+        'Requests handled, by route and status code', ('path', 'code'))
+REQUEST_SECONDS = METRICS.registry.histogram('classifurlr_request_duration_seconds',
+        'Time to handle a request, by route', ('path',))
+IN_FLIGHT = METRICS.registry.gauge('classifurlr_requests_in_flight',
+        'Requests being handled, by route', ('path',))
+ROUTES = ('url', 'theme', 'metrics')
+
+# Callers with a deadline can pass /url?budget=<seconds> to get the best
+# verdict available in that time.
+def time_budget(environ):
+    budget = parse_qs(environ.get('QUERY_STRING', '')).get('budget')
+    if budget is None: return None
+    budget = float(budget[0])
+    if not math.isfinite(budget) or budget < 0:
+        raise ValueError('budget must be a non-negative number of seconds')
+    return budget
+
+def record_request(route, code, started):
+    IN_FLIGHT.dec(route)
+    REQUESTS.inc(route, code)
+    REQUEST_SECONDS.observe(time.perf_counter() - started, route)
+
+# A response body that records its request once the server is done with it,
+# so the duration includes sending the (possibly streamed) body.
+class CountedResponse:
+    def __init__(self, body, route, codes, started):
+        self.body = body
+        self.route = route
+        self.codes = codes
+        self.started = started
+        self.failed = False
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.body
+        except Exception:
+            self.failed = True
+            raise
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            code = '500' if self.failed or not self.codes else self.codes[0]
+            record_request(self.route, code, self.started)
 
 def application(environ, start_response):
     path = environ['PATH_INFO'].strip(' /').lower()
+    # Unknown paths share a label so they can't blow up the number of series.
+    route = path if path in ROUTES else 'other'
+    started = time.perf_counter()
+    IN_FLIGHT.inc(route)
+    codes = []
+    def start_counted_response(status, headers, exc_info=None):
+        codes.append(status.split(' ', 1)[0])
+        return start_response(status, headers, exc_info)
+    try:
+        body = route_request(path, environ, start_counted_response)
+    except Exception:
+        record_request(route, '500', started)
+        raise
+    return CountedResponse(body, route, codes, started)
+
+def route_request(path, environ, start_response):
     if path == 'url':
-        session = json.loads(environ['wsgi.input'].read().decode('utf-8'))
+        try:
+            budget = time_budget(environ)
+        except ValueError:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return [b'budget must be a non-negative number of seconds']
+        session = classifurlr.loads_session(environ['wsgi.input'].read())
+        c = classifurlr.run(session, cache=CACHE, time_budget=budget, metrics=METRICS)
         status = '201 Created'
         headers = [('Content-Type', 'application/json')]
         start_response(status, headers)
-        c = classifurlr.run(session)
-        return [c.as_json().encode('utf-8')]
+        return serialization.iter_chunks(c)
     elif path == 'theme':
         data = json.loads(environ['wsgi.input'].read().decode('utf-8'))
         theme = data['theme']
         country = data['country_code']
         statuses = data['url_statuses']
+        c = classifurlr.theme_status.run(theme, country, statuses)
         status = '201 Created'
         headers = [('Content-Type', 'application/json')]
         start_response(status, headers)
-        c = classifurlr.theme_status.run(theme, country, statuses)
         return [c.as_json().encode('utf-8')]
+    elif path == 'metrics':
+        status = '200 OK'
+        headers = [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')]
+        start_response(status, headers)
+        return [METRICS.registry.exposition().encode('utf-8')]
     else:
         status = '404 Not Found'
         headers = []
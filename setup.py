@@ -13,9 +13,9 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/berkmancenter/py_classifurlr",
     packages=setuptools.find_packages(),
+    package_data={'classifurlr': ['data/*.json']},
     classifiers=[ "Programming Language :: Python :: 3" ],
     install_requires=[
-        'haralyzer',
         'beautifulsoup4',
         'numpy',
         'tldextract',
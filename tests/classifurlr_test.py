@@ -1,6 +1,23 @@
-import unittest, json
-from classifurlr import run
+import unittest, json, io, os, tempfile, copy, base64, codecs, types, contextlib
+import sys, time, concurrent.futures, wsgiref.util
+import numpy as np
+import classifurlr
+import server
+from classifurlr import run, run_incremental, rerun, serialization, ResultCache
+from classifurlr.time_utils import parse_timestamp, timestamp_micros
+from classifurlr.classification import ClassifyPipeline, Session, TimeBudgetExceededError
+from classifurlr.features import PageFeatures
+from classifurlr.batch import FeatureBatch
+from classifurlr.entry_index import EntryIndex, IndexedEntry
+from classifurlr.filters import Filter, InconclusiveFilter
+from classifurlr import reprocess
+from classifurlr.classifiers.signatures import SignatureDatabase, SignatureSet
+from classifurlr.classifiers.block_page import PageEntryIndex
+from classifurlr import har_utils
+from classifurlr.har_page import load_pages
 from classifurlr.classifiers import *
+from classifurlr.classifiers.similarity_metrics import similarity_metrics, Document
+from classifurlr.classifiers import similarity_metrics as metrics_module
 
 FIXTURE_DIR = 'tests/fixtures/'
 def test_result(session_filename):
@@ -14,6 +31,40 @@ class DifferingDomainTest(unittest.TestCase):
         self.assertTrue(d.is_ip('https://192.128.0.1:80'))
         self.assertFalse(d.is_ip('https://www.google.com'))
 
+class SignatureDatabaseTest(unittest.TestCase):
+    def write_signatures(self, path, version, mtime):
+        with open(path, 'w') as f:
+            json.dump({'version': version, 'countries': {
+                'SA': {'urls': ['https?://sa.example']},
+                'UZ': {'body_text': ['blocked (uz)']},
+                'global': {'headers': [['Server', 'Blocker']]}}}, f)
+        os.utime(path, (mtime, mtime))
+
+    def test_country_buckets_and_reload(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'signatures.json')
+            self.write_signatures(path, '1', 1000)
+            db = SignatureDatabase(path, reload_interval=0)
+            sa = db.for_country('sa')
+            self.assertEqual(1, len(sa.url_patterns))
+            self.assertEqual(0, len(sa.body_patterns))
+            self.assertEqual(1, len(sa.header_patterns))
+            self.assertEqual(1, len(db.for_country(None).body_patterns))
+            self.write_signatures(path, '2', 2000)
+            db.for_country('SA')
+            self.assertEqual('2', db.version)
+            classifier = BlockpageSignatureClassifier(db)
+            self.assertEqual('0.1+2', classifier.version)
+
+class ErrorTest(unittest.TestCase):
+    def test_blocked_in_china(self):
+        self.assertTrue(test_result('many_google_tests_from_china.json').is_blocked())
+
+    def test_single_page_not_enough(self):
+        result = test_result('single_utorrent_china.json')
+        self.assertTrue(result.is_down())
+        self.assertFalse(result.is_blocked())
+
 class StatusCodeTest(unittest.TestCase):
     def test_non_200(self):
         filename = '403.json'
@@ -27,6 +78,33 @@ class InconclusiveFilterTest(unittest.TestCase):
         result = test_result(filename)
         self.assertTrue(result.is_inconclusive())
 
+    def test_cheap_checks_first(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = Session(json.load(f))
+        pages = session.get_pages()
+        session['pageDetail'][pages[0].page_id]['errors'] = [
+                "(28, 'Operation timed out after 30000 milliseconds')"]
+        keep, toss = InconclusiveFilter().filter(session, pages)
+        self.assertEqual([pages[0]], toss)
+        self.assertEqual(pages[1:], keep)
+        # Only the pages still in the running had their bodies checked.
+        indexed = EntryIndex.for_session(session).entries
+        self.assertNotIn(har_utils.entry_to_key(pages[0].actual_page), indexed)
+        self.assertIn(har_utils.entry_to_key(pages[1].actual_page), indexed)
+
+    def test_shared_across_sessions(self):
+        filt = InconclusiveFilter()
+        sessions = []
+        for filename in ('kickass.json', 'many_example-com.json') * 4:
+            with open(FIXTURE_DIR + filename, 'r') as f:
+                sessions.append(Session(json.load(f)))
+        expected = [[p.page_id for p in filt.filter(s, s.get_pages())[1]] for s in sessions]
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            tossed = pool.map(lambda s: [p.page_id for p in filt.filter(s, s.get_pages())[1]],
+                    sessions)
+        self.assertEqual(expected, list(tossed))
+        self.assertTrue(len(expected[0]) > 0)
+
 class BlockpageSignatureTest(unittest.TestCase):
     def test_redirects_to_different_domain(self):
         filename = 'lesbiansubmission.json'
@@ -38,5 +116,736 @@ class BlockpageSignatureTest(unittest.TestCase):
         result = test_result(filename)
         self.assertFalse(result.is_blocked())
 
+class TimestampTest(unittest.TestCase):
+    def test_parse_timestamp(self):
+        self.assertEqual(1485854243.0, parse_timestamp('2017-01-31T09:17:23Z'))
+        self.assertEqual(1473264108.337, parse_timestamp('2016-09-07T16:01:48.337Z'))
+        self.assertEqual(1485854243.0, parse_timestamp('Tue, 31 Jan 2017 09:17:23 GMT'))
+
+    def test_naive_timestamps_agree(self):
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Asia/Tehran'
+        time.tzset()
+        try:
+            for value in ('2017-01-31T09:17:23.25', 'Tue, 31 Jan 2017 09:17:23'):
+                self.assertEqual(parse_timestamp(value) * 1000000, timestamp_micros(value))
+            self.assertNotEqual(1485854243.0, parse_timestamp('2017-01-31T09:17:23'))
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+
+class HarPageTest(unittest.TestCase):
+    def entry(self, pageref, started, time, status=200, size=100):
+        return {'pageref': pageref, 'startedDateTime': started, 'time': time,
+                'request': {'url': 'http://example.com/{}'.format(started[-7:])},
+                'response': {'status': status, 'content': {'size': size}}}
+
+    def test_load_pages(self):
+        har = {'log': {'pages': [
+            {'id': 'a', 'startedDateTime': '2019-01-01T00:00:00.000Z', 'pageTimings': {}},
+            {'id': 'b', 'startedDateTime': '2019-01-02T00:00:00.000Z'}],
+            'entries': [
+                self.entry('a', '2019-01-01T00:00:00.100Z', 50),
+                self.entry('b', '2019-01-02T00:00:00.000Z', 10, status=302, size=-1),
+                self.entry('a', '2019-01-01T00:00:00.000Z', 200, status=301, size=0),
+                self.entry('a', '2019-01-01T00:00:00.5005Z', 10),
+                self.entry('missing', '2019-01-01T00:00:00.000Z', 10)]}}
+        a, b = load_pages(har)
+        self.assertEqual('http://example.com/00.000Z', a.url)
+        self.assertEqual([a.entries[0]], a.redirect_chain)
+        self.assertIs(a.entries[1], a.actual_page)
+        self.assertEqual(200, a.total_size)
+        # 0-200ms, overlapping 100-150ms, and 500.5-510.5ms off the
+        # millisecond grid of the others.
+        self.assertEqual(210, a.get_load_time())
+        self.assertIsNone(b.actual_page)
+        self.assertEqual(0, b.total_size)
+        self.assertEqual({}, b.pageTimings)
+
+class FeatureClassifierTest(unittest.TestCase):
+    def test_matches_per_page_logic(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = Session(json.load(f))
+        pages = session.get_pages()
+        session.baseline = pages[0]
+        # Make one page a different length and drop another's status.
+        pages[1].actual_page['response']['content']['size'] *= 3
+        del pages[2].actual_page['response']['status']
+        features = PageFeatures.for_session(session)
+        self.assertEqual(len(pages), len(features))
+        self.assertTrue(np.isnan(features.status[2]))
+
+        baseline_len = pages[0].actual_page['response']['content']['size']
+        for page in pages:
+            this_len = page.actual_page['response']['content']['size']
+            ratio = abs(baseline_len - this_len) / max(baseline_len, this_len)
+            length = PageLengthClassifier().classify_page(page, session)
+            self.assertEqual(ratio >= 0.3019, length.is_down())
+            empty = EmptyPageClassifier().classify_page(page, session)
+            self.assertEqual(page.total_size <= 300, empty.is_down())
+            status = StatusCodeClassifier().classify_page(page, session)
+            if page is pages[2]:
+                self.assertTrue(status.is_inconclusive())
+                self.assertIn('"status" not found', str(status.error))
+            else:
+                code = page.actual_page['response']['status']
+                self.assertEqual(not 200 <= code <= 299, status.is_down())
+        self.assertTrue(PageLengthClassifier().classify_page(pages[1], session).is_down())
+
+    def test_no_baseline(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = Session(json.load(f))
+        c = PageLengthClassifier().classify_page(session.get_pages()[0], session)
+        self.assertTrue(c.is_inconclusive())
+
+class FeatureBatchTest(unittest.TestCase):
+    def sessions(self):
+        sessions = []
+        for filename in sorted(os.listdir(FIXTURE_DIR)):
+            with open(FIXTURE_DIR + filename, 'r') as f:
+                sessions.append(Session(json.load(f)))
+        many = max(sessions, key=lambda s: len(s.get_pages()))
+        pages = many.get_pages()
+        many.baseline = pages[0]
+        pages[1].actual_page['response']['content']['size'] *= 3
+        return sessions
+
+    def test_matches_per_page_classification(self):
+        classifiers = [StatusCodeClassifier(), EmptyPageClassifier(),
+                PageLengthClassifier(), ThrottleClassifier()]
+        batch = FeatureBatch.from_sessions(self.sessions())
+        self.assertEqual(sum(len(s.get_pages()) for s in batch.sessions), len(batch))
+        for classifier in classifiers:
+            for session, results in zip(batch.sessions, batch.classify(classifier)):
+                expected = [classifier.classify_page(page, session).as_dict()
+                        for page in session.get_pages()]
+                self.assertEqual(expected, [c.as_dict() for c in results])
+
+    def test_save_and_load(self):
+        batch = FeatureBatch.from_sessions(self.sessions())
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'features.npz')
+            batch.save(path)
+            loaded = FeatureBatch.load(path)
+        self.assertEqual(batch.session_ids, loaded.session_ids)
+        self.assertEqual(batch.features.page_ids, loaded.features.page_ids)
+        classifier = PageLengthClassifier()
+        for expected, actual in zip(batch.verdicts(classifier), loaded.verdicts(classifier)):
+            np.testing.assert_array_equal(expected, actual)
+        with self.assertRaises(ValueError):
+            loaded.classify(classifier)
+
+class StreamPagesTest(unittest.TestCase):
+    def test_same_result_as_classify_session(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            data = json.load(f)
+        stale = [p['id'] for p in data['har']['log']['pages'][:4]]
+        for item in data['har']['log']['pages'] + data['har']['log']['entries']:
+            if item.get('id', item.get('pageref')) in stale:
+                item['startedDateTime'] = '2015' + item['startedDateTime'][4:]
+        for prune in (False, True):
+            expected = run(copy.deepcopy(data), prune_stale_pages=prune)
+            pipeline = classifurlr.default_pipeline(prune, stream_pages=True)
+            session = Session(copy.deepcopy(data))
+            streamed = pipeline.classify_stream(session)
+            self.assertEqual(expected.as_dict(), streamed.as_dict())
+            # Pages were never all built at once.
+            self.assertIsNone(session.pages)
+            self.assertEqual(4 if prune else 0, len(pipeline.pruned))
+
+class TimeBudgetTest(unittest.TestCase):
+    def test_skips_expensive_classifiers_when_out_of_time(self):
+        with open(FIXTURE_DIR + 'samurpress.json', 'r') as f:
+            data = json.load(f)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = ResultCache(os.path.join(tmpdir, 'cache.sqlite'))
+            pipeline = classifurlr.default_pipeline(cache=cache, time_budget=0)
+            c = pipeline.classify(copy.deepcopy(data))
+            self.assertEqual(0, cache.size())
+            cache.close()
+        pages = c.get_constituents()
+        self.assertEqual(len(pages) * 2, len(pipeline.skipped))
+        for page in pages:
+            for constituent in page.get_constituents():
+                if constituent.classifier.expensive:
+                    self.assertTrue(constituent.is_inconclusive())
+                    self.assertIn('time budget', str(constituent.error))
+                else:
+                    self.assertNotIsInstance(constituent.error, TimeBudgetExceededError)
+        # Given enough time, nothing is skipped.
+        self.assertEqual(run(copy.deepcopy(data)).as_dict(),
+                run(data, time_budget=60).as_dict())
+        with self.assertRaises(ValueError):
+            classifurlr.default_pipeline(stream_pages=True, time_budget=1)
+
+    def test_filtering_not_counted(self):
+        class SlowFilter(Filter):
+            def filtered_out_ids(self, session, pages):
+                time.sleep(0.6)
+                return set()
+        with open(FIXTURE_DIR + 'samurpress.json', 'r') as f:
+            data = json.load(f)
+        pipeline = classifurlr.default_pipeline(time_budget=0.5)
+        pipeline.filters.append(SlowFilter())
+        pipeline.classify(data)
+        self.assertEqual([], pipeline.skipped)
+
+class ReprocessTest(unittest.TestCase):
+    def read_results(self, output_dir):
+        results = {}
+        for shard in range(2):
+            with open(reprocess.results_path(output_dir, shard), 'rb') as f:
+                results[shard] = f.read()
+        return results
+
+    def test_resumes_where_it_stopped(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            sessions, _ = reprocess.reprocess(FIXTURE_DIR, output_dir, workers=2,
+                    checkpoint_every=1, out=io.StringIO())
+            self.assertEqual(len(os.listdir(FIXTURE_DIR)), sessions)
+            complete = self.read_results(output_dir)
+            lines = [json.loads(line) for line in complete[0].splitlines()]
+            with open(FIXTURE_DIR + lines[0]['file'], 'r') as f:
+                self.assertEqual(run(classifurlr.load_session(f)).as_dict(),
+                        lines[0]['result'])
+
+            # Pretend shard 0 died partway through writing its second result.
+            first_line = complete[0].index(b'\n') + 1
+            reprocess.write_json_atomic(reprocess.checkpoint_path(output_dir, 0),
+                    {'done': 1, 'offset': first_line, 'pages': 0})
+            with open(reprocess.results_path(output_dir, 0), 'ab') as f:
+                f.write(b'{"file":"half a line')
+            sessions, _ = reprocess.reprocess(FIXTURE_DIR, output_dir,
+                    out=io.StringIO())
+            self.assertEqual(len(lines) - 1, sessions)
+            self.assertEqual(complete, self.read_results(output_dir))
+
+            # Shards whose results are missing or cut short start over.
+            os.remove(reprocess.results_path(output_dir, 0))
+            with open(reprocess.results_path(output_dir, 1), 'r+b') as f:
+                f.truncate(10)
+            sessions, _ = reprocess.reprocess(FIXTURE_DIR, output_dir,
+                    out=io.StringIO())
+            self.assertEqual(len(os.listdir(FIXTURE_DIR)), sessions)
+            self.assertEqual(complete, self.read_results(output_dir))
+
+class NearDuplicateTest(unittest.TestCase):
+    BLOCK_PAGE = ('<html><head><title>Access denied</title></head><body>'
+            '<div class="notice"><h1>This site has been blocked</h1><p>Access to '
+            'this website has been restricted by order of the court under the '
+            'telecommunications act. Request {} at {}.</p></div></body></html>')
+
+    def test_index(self):
+        index = BlockpageIndex()
+        index.add('court-order', self.BLOCK_PAGE.format(1, '2016-03-12 12:44'))
+        index.add('unrelated', '<html><body><p>Welcome to my blog about '
+                'gardening, cats and the weather in Boston</p></body></html>')
+        reference_id, similarity = index.query(
+                self.BLOCK_PAGE.format(88213, '2019-01-02 00:00'))
+        self.assertEqual('court-order', reference_id)
+        self.assertEqual(1.0, similarity)
+        self.assertIsNone(index.query('<html><body><h1>Example Domain</h1><p>This '
+                'domain is for use in illustrative examples</p></body></html>'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index.npz')
+            index.save(path)
+            loaded = BlockpageIndex.load(path)
+        self.assertEqual(['court-order', 'unrelated'], loaded.ids)
+        self.assertTrue((index.signatures == loaded.signatures).all())
+        self.assertEqual(index.query(self.BLOCK_PAGE), loaded.query(self.BLOCK_PAGE))
+        loaded.add('another', self.BLOCK_PAGE)
+        self.assertEqual(3, len(loaded.signatures))
+        self.assertEqual(('court-order', 1.0), loaded.query(self.BLOCK_PAGE))
+
+    def test_classifier(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = Session(json.load(f))
+        page = session.get_pages()[0]
+        index = BlockpageIndex()
+        index.add('example', har_utils.har_entry_response_text(page.actual_page,
+            classifurlr.DEFAULT_SCAN_WINDOW))
+        classifier = NearDuplicateBlockpageClassifier(index)
+        c = classifier.classify_page(page, session)
+        self.assertTrue(c.is_down())
+        self.assertTrue(c.is_blocked())
+        self.assertEqual('example', c.as_dict()['details']['reference'])
+
+        index = BlockpageIndex()
+        index.add('court-order', self.BLOCK_PAGE)
+        c = NearDuplicateBlockpageClassifier(index).classify_page(page, session)
+        self.assertTrue(c.is_up())
+        self.assertNotIn('details', c.as_dict())
+
+    def test_version_follows_index_and_threshold(self):
+        index = BlockpageIndex()
+        index.add('court-order', self.BLOCK_PAGE)
+        version = NearDuplicateBlockpageClassifier(index).version
+        self.assertNotEqual(version,
+                NearDuplicateBlockpageClassifier(index, threshold=0.9).version)
+        index.add('another', self.BLOCK_PAGE.format(1, 2))
+        self.assertNotEqual(version, NearDuplicateBlockpageClassifier(index).version)
+
+class SimilarityMetricsTest(unittest.TestCase):
+    PAGE = '<html><body><table width="10"><tr><td>One</td></tr></table></body></html>'
+    OTHER = '<html><body><div><p>Two</p><p>Three</p></div></body></html>'
+
+    def test_only_computes_requested_metrics(self):
+        baseline = Document(self.PAGE)
+        metrics = similarity_metrics(baseline, self.OTHER, metrics=('cosine similarity',))
+        self.assertEqual(['cosine similarity'], list(metrics))
+        self.assertNotIn('dom similarity', metrics)
+        self.assertLess(metrics['cosine similarity'], 0.5)
+        self.assertNotIn('dom_couples', vars(baseline))
+        with self.assertRaises(ValueError):
+            similarity_metrics(self.PAGE, self.OTHER, metrics=('nope',))
+
+    def test_pages_dont_add_up(self):
+        everything = dict(similarity_metrics(self.PAGE, self.OTHER))
+        self.assertEqual(4, len(everything))
+        for _ in range(2):
+            metrics = similarity_metrics(self.OTHER, self.OTHER)
+            self.assertAlmostEqual(1.0, metrics['cosine similarity'])
+            self.assertEqual(1.0, metrics['dom similarity'])
+
+    def test_corpus_matrices(self):
+        pages = [self.PAGE, self.OTHER, self.OTHER + '<p>Four</p>']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for i, page in enumerate(pages):
+                with open(os.path.join(tmpdir, '{}.html'.format(i)), 'w') as f:
+                    f.write(page)
+            files, cosine, ratio = metrics_module.corpus_matrices([tmpdir], workers=2)
+            output = os.path.join(tmpdir, 'matrix.npz')
+            metrics_module.write_matrices(output, files, cosine, ratio)
+            with np.load(output) as saved:
+                self.assertEqual(files, saved['files'].tolist())
+                self.assertTrue((cosine == saved['cosine_similarity']).all())
+            # A rerun ignores the saved matrix, and skips pages that aren't text
+            binary = os.path.join(tmpdir, 'logo.htm')
+            with open(binary, 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n\xff\xfe\x00')
+            with contextlib.redirect_stderr(io.StringIO()):
+                rerun = metrics_module.corpus_matrices([tmpdir], workers=2)
+            self.assertEqual(files, rerun[0])
+            self.assertTrue((cosine == rerun[1]).all())
+        self.assertEqual((3, 3), cosine.shape)
+        for i, page1 in enumerate(pages):
+            for j, page2 in enumerate(pages):
+                metrics = similarity_metrics(page1, page2)
+                self.assertAlmostEqual(metrics['cosine similarity'], cosine[i, j])
+                self.assertAlmostEqual(metrics['length ratio'], ratio[i, j])
+
+class MetricsTest(unittest.TestCase):
+    def test_counts_and_times_the_pipeline(self):
+        metrics = classifurlr.PipelineMetrics()
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            data = json.load(f)
+        duplicate_pages(data, 3)
+        c = run(copy.deepcopy(data), metrics=metrics)
+        self.assertEqual(run(data).as_dict(), c.as_dict())
+        with open(FIXTURE_DIR + 'kickass.json', 'r') as f:
+            run(json.load(f), metrics=metrics) # all filtered out
+        pages = len(c.get_constituents())
+        text = metrics.registry.exposition()
+        self.assertIn('classifurlr_sessions_total{status="inconclusive"} 1\n', text)
+        self.assertIn('classifurlr_session_duration_seconds_count 2\n', text)
+        self.assertIn('classifurlr_filtered_pages_total{filter="inconclusive"}', text)
+        self.assertIn('# TYPE classifurlr_classifier_duration_seconds histogram', text)
+        self.assertIn('classifurlr_classifier_duration_seconds_bucket'
+                '{{classifier="status_code",le="+Inf"}} {}\n'.format(pages - 3), text)
+        verdicts = sum(value for (slug, _, _), value in metrics.verdicts.values.items()
+                if slug == 'status_code')
+        self.assertEqual(pages, verdicts)
+        self.assertIn('classifurlr_classifier_verdicts_total{classifier="status_code",'
+                'status="up",reused="true"} 3\n', text)
+        self.assertEqual(pages, sum(metrics.pages.values.values()))
+
+class ServerTest(unittest.TestCase):
+    def request(self, path, body=b'', query=''):
+        environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'REQUEST_METHOD': 'POST',
+                'wsgi.input': io.BytesIO(body)}
+        wsgiref.util.setup_testing_defaults(environ)
+        statuses = []
+        response = server.application(environ,
+                lambda status, headers, exc_info=None: statuses.append(status))
+        try:
+            return statuses[0], b''.join(response)
+        finally:
+            response.close()
+
+    def count(self, route, code):
+        return server.REQUESTS.values.get((route, code), 0)
+
+    def test_budget(self):
+        for budget in ('nan', '-1', 'soon', 'inf'):
+            status, _ = self.request('/url', query='budget=' + budget)
+            self.assertEqual('400 Bad Request', status)
+        with open(FIXTURE_DIR + 'samurpress.json', 'rb') as f:
+            data = f.read()
+        status, body = self.request('/url', data, 'budget=0')
+        self.assertEqual('201 Created', status)
+        constituents = json.loads(body.decode('utf-8'))['constituents'][0]['constituents']
+        self.assertIn('time budget', str([c['error'] for c in constituents]))
+
+    def test_metrics(self):
+        created, failed = self.count('url', '201'), self.count('url', '500')
+        with open(FIXTURE_DIR + 'samurpress.json', 'rb') as f:
+            self.request('/url', f.read())
+        with self.assertRaises(KeyError): # loads, but has no URL to classify
+            self.request('/url', b'{"har": {"log": {"pages": [], "entries": []}}}')
+        self.assertEqual(created + 1, self.count('url', '201'))
+        self.assertEqual(failed + 1, self.count('url', '500'))
+        status, body = self.request('/metrics')
+        self.assertEqual('200 OK', status)
+        text = body.decode('utf-8')
+        self.assertIn('classifurlr_requests_total{{path="url",code="201"}} {}\n'.format(
+            created + 1), text)
+        self.assertIn('classifurlr_requests_in_flight{path="metrics"} 1\n', text)
+        self.assertIn('classifurlr_classifier_verdicts_total{classifier="status_code"', text)
+
+class PruneStalePagesTest(unittest.TestCase):
+    def test_prunes_pages_outside_look_back_window(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = json.load(f)
+        stale = [p['id'] for p in session['har']['log']['pages'][:4]]
+        for item in session['har']['log']['pages'] + session['har']['log']['entries']:
+            if item.get('id', item.get('pageref')) in stale:
+                item['startedDateTime'] = '2015' + item['startedDateTime'][4:]
+        pruned = run(json.loads(json.dumps(session)), prune_stale_pages=True)
+        unpruned = run(session)
+        self.assertEqual(len(unpruned.get_constituents()) - 4,
+                len(pruned.get_constituents()))
+        self.assertEqual(unpruned.direction, pruned.direction)
+        self.assertAlmostEqual(unpruned.confidence, pruned.confidence)
+        self.assertEqual(sorted(stale), sorted(pruned.as_dict()['details']['pruned']))
+
+    def test_keeps_stale_pages_that_look_blocked(self):
+        with open(FIXTURE_DIR + 'many_google_tests_from_china.json', 'r') as f:
+            session = json.load(f)
+        pages = sorted(session['har']['log']['pages'], key=lambda p: p['startedDateTime'])
+        stale = [p['id'] for p in pages[:3]]
+        for item in session['har']['log']['pages'] + session['har']['log']['entries']:
+            if item.get('id', item.get('pageref')) in stale:
+                item['startedDateTime'] = '2015' + item['startedDateTime'][4:]
+        # Only the stale pages are from a vantage point known to block.
+        for page_id, details in session['pageDetail'].items():
+            if page_id not in stale:
+                details['countryCode'] = 'US'
+        for stream_pages in (False, True):
+            unpruned = run(copy.deepcopy(session), stream_pages=stream_pages)
+            pruned = run(copy.deepcopy(session), prune_stale_pages=True,
+                    stream_pages=stream_pages)
+            self.assertTrue(unpruned.is_blocked())
+            self.assertTrue(pruned.is_blocked())
+            self.assertEqual(unpruned.direction, pruned.direction)
+            self.assertAlmostEqual(unpruned.confidence, pruned.confidence)
+            self.assertEqual([], pruned.as_dict()['details']['pruned'])
+
+# Adds a copy of each of the first count pages, with "_dup" on the end of
+# its ID.
+def duplicate_pages(session, count):
+    log = session['har']['log']
+    for page in log['pages'][:count]:
+        copy_id = page['id'] + '_dup'
+        log['pages'].append(dict(page, id=copy_id))
+        log['entries'] += [dict(entry, pageref=copy_id) for entry in log['entries']
+                if entry['pageref'] == page['id']]
+        session['pageDetail'][copy_id] = session['pageDetail'][page['id']]
+
+class DedupePagesTest(unittest.TestCase):
+    def classify(self, session, dedupe_pages, time_budget=None, metrics=None):
+        classifiers = [(StatusCodeClassifier(), 1.0), (ErrorClassifier(), 1.0),
+                (ThrottleClassifier(), 1.0), (BlockpageSignatureClassifier(), 1.0)]
+        pipeline = ClassifyPipeline([], classifiers, [], dedupe_pages=dedupe_pages,
+                time_budget=time_budget, metrics=metrics)
+        return pipeline.classify(session)
+
+    def test_reused_results_match(self):
+        with open(FIXTURE_DIR + 'many_google_tests_from_china.json', 'r') as f:
+            session = json.load(f)
+        deduped = self.classify(session, True)
+        fresh = self.classify(session, False)
+        self.assertEqual(fresh.as_dict(), deduped.as_dict())
+
+    def test_errors_name_the_reused_page(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = json.load(f)
+        duplicate_pages(session, 3)
+        deduped = self.classify(session, True)
+        fresh = self.classify(session, False)
+        self.assertEqual(fresh.as_dict(), deduped.as_dict())
+        errors = [str(c.get_constituent_from(ErrorClassifier).error)
+                for c in deduped.get_constituents() if c.subject.page_id.endswith('_dup')]
+        self.assertEqual(3, len(errors))
+        self.assertTrue(all('_dup' in error for error in errors))
+
+    def test_budgeted_reuses_the_same_results(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = json.load(f)
+        duplicate_pages(session, 3)
+        reused = []
+        for time_budget in (None, 60):
+            metrics = classifurlr.PipelineMetrics()
+            c = self.classify(copy.deepcopy(session), True, time_budget, metrics)
+            reused.append(sorted((key, value) for key, value in metrics.verdicts.values.items()
+                if key[2] == 'true'))
+        self.assertEqual(self.classify(session, False).as_dict(), c.as_dict())
+        self.assertEqual(reused[0], reused[1])
+        # Results with errors and the timing-based throttle classifier's
+        # results are never reused
+        self.assertEqual(set(['status_code', 'block_page_signature']),
+                set(key[0] for key, _ in reused[0]))
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(os.path.join(self.tmpdir.name, 'cache.sqlite'))
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            self.session = json.load(f)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_hit_returns_same_result(self):
+        fresh = run(self.session, cache=self.cache)
+        cached = run(self.session, cache=self.cache)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(fresh.as_dict(), cached.as_dict())
+        self.assertEqual(fresh.get_constituents()[0].subject.page_id,
+                cached.get_constituents()[0].subject.page_id)
+
+    def test_version_change_invalidates(self):
+        run(self.session, cache=self.cache)
+        version = StatusCodeClassifier.__init__
+        def bumped(classifier):
+            version(classifier)
+            classifier.version = '0.2'
+        StatusCodeClassifier.__init__ = bumped
+        try:
+            run(self.session, cache=self.cache)
+        finally:
+            StatusCodeClassifier.__init__ = version
+        self.assertEqual(0, self.cache.hits)
+        count = self.cache.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        self.assertEqual(1, count)
+
+    def test_evicts_to_max_size(self):
+        self.cache.max_size = 1
+        run(self.session, cache=self.cache)
+        self.assertEqual(0, self.cache.size())
+
+    def test_keeps_a_running_total(self):
+        statements = []
+        self.cache.db.set_trace_callback(statements.append)
+        result = run(self.session)
+        sizes = []
+        for i in range(20):
+            self.cache.put('session {}'.format(i % 15), 'signature', result)
+            sizes.append(self.cache.total)
+        self.cache.db.set_trace_callback(None)
+        self.assertFalse([s for s in statements if 'SUM' in s and 'WHERE' not in s])
+        self.assertEqual(self.cache.size(), self.cache.total)
+        self.assertEqual(sizes[14], sizes[19]) # the last five replaced earlier ones
+        # Evicting goes a little below the limit, then the total grows again.
+        self.cache.max_size = sizes[14] - 1
+        self.cache.put('another session', 'signature', result)
+        self.assertEqual(self.cache.size(), self.cache.total)
+        self.assertLessEqual(self.cache.total, self.cache.max_size * 0.9)
+        self.assertGreater(self.cache.total, 0)
+
+class IncrementalTest(unittest.TestCase):
+    def only_pages(self, session, page_ids):
+        session = copy.deepcopy(session)
+        log = session['har']['log']
+        log['pages'] = [p for p in log['pages'] if p['id'] in page_ids]
+        log['entries'] = [e for e in log['entries'] if e['pageref'] in page_ids]
+        return session
+
+    def test_matches_full_run(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = json.load(f)
+        full = run(copy.deepcopy(session))
+        page_ids = [p['id'] for p in session['har']['log']['pages']]
+        state = {'result': {}, 'startedDateTimes': {}}
+        for new_ids in [page_ids[:5], page_ids[5:]]:
+            new_ids = set(new_ids) | set([session['baseline']])
+            result, state = run_incremental(state, self.only_pages(session, new_ids))
+            state = json.loads(json.dumps(state))
+        self.assertEqual(full.as_dict(), result.as_dict())
+
+    def test_error_rules_see_old_pages(self):
+        with open(FIXTURE_DIR + 'many_example-com.json', 'r') as f:
+            session = json.load(f)
+        page_ids = [p['id'] for p in session['har']['log']['pages']]
+        for page_id in page_ids:
+            session['pageDetail'][page_id].update(countryCode='tr', asn=197328)
+        # The TR rule needs more than one page with the error, and each batch
+        # only has one.
+        for page_id in (page_ids[1], page_ids[-1]):
+            session['pageDetail'][page_id]['errors'] = [
+                    "(56, 'Recv failure: Connection reset by peer')"]
+        metrics = classifurlr.PipelineMetrics()
+        full = classifurlr.default_pipeline(prune_stale_pages=True).classify(
+                copy.deepcopy(session))
+        self.assertTrue(full.is_blocked())
+        pipeline = classifurlr.default_pipeline(prune_stale_pages=True, metrics=metrics)
+        previous = pipeline.classify(self.only_pages(session,
+            set(page_ids[:6]) | set([session['baseline']])))
+        self.assertFalse(previous.is_blocked())
+        state = json.loads(json.dumps(pipeline.session_state(previous)))
+        for pipeline, previous in ((pipeline, previous), (classifurlr.default_pipeline(
+                prune_stale_pages=True, metrics=metrics), state)):
+            result = pipeline.classify_incremental(previous, self.only_pages(session,
+                set(page_ids[6:]) | set([session['baseline']])))
+            self.assertEqual(full.as_dict(), result.as_dict())
+        self.assertIn('classifurlr_sessions_total{status="down"} 2\n',
+                metrics.registry.exposition())
+
+class RerunTest(unittest.TestCase):
+    def test_only_changed_classifiers_rerun(self):
+        with open(FIXTURE_DIR + '403.json', 'r') as f:
+            session = json.load(f)
+        stored = run(copy.deepcopy(session)).as_dict()
+        for constituent in stored['constituents'][0]['constituents']:
+            if constituent['classifier'] == 'status_code':
+                # Stale version, so this gets recomputed
+                constituent['version'] = '0.0'
+                constituent['status'] = 'up'
+            if constituent['classifier'] == 'empty_page':
+                # Current version, so this is trusted as-is
+                constituent['status'] = 'inconclusive'
+        result = rerun(stored, session).get_constituents()[0]
+        self.assertTrue(result.get_constituent_from(StatusCodeClassifier).is_down())
+        self.assertTrue(result.get_constituent_from(EmptyPageClassifier).is_inconclusive())
+
+class ContentKindTest(unittest.TestCase):
+    def entry(self, mime_type, text=None, encoding=None):
+        content = {'mimeType': mime_type, 'size': 10}
+        if text is not None: content['text'] = text
+        if encoding is not None: content['encoding'] = encoding
+        return {'response': {'content': content}}
+
+    def test_kinds(self):
+        png = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAAB'
+        self.assertEqual(har_utils.BINARY, har_utils.entry_content_kind(self.entry('image/jpeg')))
+        self.assertEqual(har_utils.BINARY, har_utils.entry_content_kind(self.entry('', png, 'base64')))
+        self.assertEqual(har_utils.BINARY, har_utils.entry_content_kind(self.entry('text/html', png, 'base64')))
+        self.assertEqual(har_utils.TEXT, har_utils.entry_content_kind(self.entry('text/javascript; charset=UTF-8', 'var a;')))
+        self.assertEqual(har_utils.HTML, har_utils.entry_content_kind(self.entry('text/html', '<html>')))
+        self.assertEqual(har_utils.HTML, har_utils.entry_content_kind(self.entry('', '<html>')))
+
+def base64_entry(body, headers=(), mime_type='text/html'):
+    return {'request': {'url': 'http://example.com/'},
+            'startedDateTime': str(id(body)), 'pageref': 'page_0',
+            'response': {'headers': [{'name': n, 'value': v} for n, v in headers],
+                'content': {'mimeType': mime_type, 'encoding': 'base64',
+                    'text': base64.b64encode(body).decode('ascii')}}}
+
+class ResponseTextTest(unittest.TestCase):
+    def test_charset_sources(self):
+        text = '<title>Газета</title>'
+        meta = ('<meta charset="windows-1251">' + text).encode('cp1251')
+        self.assertIn(text, har_utils.har_entry_response_text(base64_entry(meta)))
+        header = base64_entry(text.encode('koi8-r'),
+                [('Content-Type', 'text/html; charset=KOI8-R')])
+        self.assertEqual(text, har_utils.har_entry_response_text(header))
+        bom = base64_entry(codecs.BOM_UTF8 + text.encode('utf-8'))
+        self.assertEqual(text, har_utils.har_entry_response_text(bom))
+
+    def test_shared_across_threads(self):
+        entries = [dict(base64_entry('<p>{}</p>'.format(i).encode('utf-8')),
+            startedDateTime=str(i)) for i in range(64)]
+        def read_and_release(entries):
+            for entry in entries:
+                har_utils.har_entry_response_text(entry)
+                har_utils.har_entry_response_content(entry)
+                har_utils.release_entry_content(entries[:8])
+            return [har_utils.har_entry_response_text(entry) for entry in entries]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6) # switch threads often enough to race
+        try:
+            with concurrent.futures.ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(read_and_release, [entries] * 16))
+        finally:
+            sys.setswitchinterval(interval)
+        for texts in results:
+            self.assertEqual(['<p>{}</p>'.format(i) for i in range(64)], texts)
+
+class EntryIndexTest(unittest.TestCase):
+    def page_index(self, *entries):
+        page = types.SimpleNamespace(page_id='page_0', entries=list(entries))
+        return PageEntryIndex(page, {'example.com'}, EntryIndex())
+
+    def test_header_names_ignore_case(self):
+        entry = base64_entry(b'<html></html>', [('X-Blocked-By', 'Blocker 1.0')])
+        self.assertEqual(['Blocker 1.0'], IndexedEntry(entry).headers['x-blocked-by'])
+        signatures = SignatureSet([{'headers': [['x-BLOCKED-by', '^Blocker']]}])
+        classifier = BlockpageSignatureClassifier()
+        self.assertTrue(classifier.contains_bad_header(self.page_index(entry), signatures))
+
+    def test_binary_bodies_skipped(self):
+        entry = base64_entry(b'\x89PNG\r\n\x1a\nblocked', mime_type='image/png')
+        self.assertEqual(har_utils.BINARY, IndexedEntry(entry).kind)
+        self.assertIsNone(IndexedEntry(entry).body())
+        signatures = SignatureSet([{'body_text': ['blocked'],
+            'body_text_full_scan': ['PNG'], 'urls': ['example']}])
+        classifier = BlockpageSignatureClassifier()
+        index = self.page_index(entry)
+        self.assertFalse(classifier.contains_bad_body_text(index, signatures))
+        self.assertFalse(classifier.contains_bad_iframe(index, signatures))
+
+class ScanWindowTest(unittest.TestCase):
+    def test_prefix_matches_full_decode(self):
+        body = ('<html>' + 'Привет, мир! ' * 10000).encode('utf-8')
+        entry = base64_entry(body,
+                [('Content-Type', 'text/html; charset=utf-8')])
+        full = har_utils.har_entry_response_text(entry)
+        for limit in [10, har_utils.BASE64_CHUNK, 50000]:
+            self.assertEqual(full[:limit], har_utils.har_entry_response_text(entry, limit))
+
+    def test_part_of_cache_signature(self):
+        signature = lambda window: ResultCache.pipeline_signature(
+                classifurlr.default_pipeline(scan_window=window))
+        default = signature(classifurlr.DEFAULT_SCAN_WINDOW)
+        self.assertIsNone(classifurlr.DEFAULT_SCAN_WINDOW) # whole bodies
+        self.assertNotEqual(default, signature(64 * 1024))
+        self.assertNotEqual(signature(64 * 1024), signature(1024))
+        self.assertEqual(default, signature(None))
+
+class LoadSessionTest(unittest.TestCase):
+    def test_drops_heavy_fields(self):
+        with open(FIXTURE_DIR + 'success_torproject-com.json', 'r') as f:
+            full = json.load(f)
+        with open(FIXTURE_DIR + 'success_torproject-com.json', 'r') as f:
+            projected = classifurlr.load_session(f)
+        self.assertTrue(all(['screenshot' not in d for d in projected['pageDetail'].values()]))
+        images = [e for e in projected['har']['log']['entries']
+                if e['response']['content']['mimeType'].startswith('image/')]
+        self.assertTrue(len(images) > 0)
+        self.assertTrue(all([e['response']['content'].get('text', '') == '' for e in images]))
+        self.assertEqual(run(full).as_dict(), run(projected).as_dict())
+
+class SerializationTest(unittest.TestCase):
+    def test_streamed_output_matches_dict(self):
+        result = test_result('many_example-com.json')
+        d = result.as_dict()
+        pretty = ''.join(serialization.iterencode(result, pretty=True))
+        self.assertEqual(json.dumps(d, indent=2), pretty)
+        out = io.BytesIO()
+        result.dump(out, encoding='utf-8')
+        self.assertEqual(d, json.loads(out.getvalue().decode('utf-8')))
+        self.assertEqual(d, json.loads(result.as_json(pretty=False)))
+
+    def test_non_finite_floats(self):
+        result = test_result('many_example-com.json')
+        result.confidence = float('nan')
+        result.get_constituents()[0].confidence = float('inf')
+        for pretty, separators in ((True, None), (False, (',', ':'))):
+            self.assertEqual(json.dumps(result.as_dict(), indent=2 if pretty else None,
+                separators=separators), result.as_json(pretty=pretty))
+
 if __name__ == '__main__':
     unittest.main()